@@ -20,37 +20,121 @@ aiohttp_requests took 0.35 seconds
 defaultdict(<class 'int'>, {200: 100})
 100 concurrent requests took 0.54 seconds
 
+defaultdict(<class 'int'>, {200: 1000})
+1000 requests with a shared session took 1.12 seconds
+
+The same requests can be made to a local server so they run offline:
+
+$ python3 async_http_requests.py --local
+...
+defaultdict(<class 'int'>, {200: 1000})
+1000 requests with a shared session took 0.47 seconds
+1000 responses from 1 request
+1000 coalesced requests took 0.05 seconds
+
+And benchmarked at a few levels of concurrency against a server that
+takes 10 ms per request, with results as JSON (trimmed here):
+
+$ python3 async_http_requests.py --benchmark
+{
+  "server": {
+    "latency": 0.01,
+    "body_size": 10000,
+    "error_rate": 0
+  },
+  "results": [
+    {
+      "concurrency": 10,
+      "requests": 2000,
+      "errors": 0,
+      "seconds": 2.823,
+      "requests_per_second": 708.5,
+      "latency_ms": {
+        "p50": 13.93,
+        "p95": 15.02,
+        "p99": 18.81
+      },
+      "sockets": 10,
+      "max_in_flight": 10
+    },
+    ...
+    {
+      "concurrency": 200,
+      "requests": 2000,
+      "errors": 0,
+      "seconds": 1.138,
+      "requests_per_second": 1757.0,
+      "latency_ms": {
+        "p50": 36.7,
+        "p95": 123.24,
+        "p99": 1057.53
+      },
+      "sockets": 200,
+      "max_in_flight": 129
+    }
+  ]
+}
+
 References
 -----------------------------------------------------------------------------
 https://github.com/maxzheng/aiohttp-requests
+https://docs.aiohttp.org/en/stable/client_advanced.html#limiting-connection-pool-size
+https://developer.mozilla.org/en-US/docs/Web/HTTP/Caching
+https://docs.aiohttp.org/en/stable/streams.html
 """
 
-from collections import defaultdict
+import codecs
+from collections import defaultdict, deque, OrderedDict
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from functools import partial
+import hashlib
+import json
+import os
+import pickle
+import random
+import sys
+from time import monotonic, perf_counter, time
 
 import aiohttp
+import aiohttp.web
 from aiohttp_requests import requests
 import asyncio
+from multidict import CIMultiDict
+from yarl import URL
 
 from utils import show_duration
 
 
-def main():
+def main(local=False):
+    """
+    :param bool local: Make requests to a local server instead of Google,
+                       so the demo can run offline.
+    """
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(request())
+    if local:
+        loop.run_until_complete(request_local())
+    else:
+        loop.run_until_complete(request())
+
 
+async def request_local():
+    async with LocalServer() as server:
+        await request(server.url)
 
-async def request():
+
+async def request(url='https://www.google.com'):
     # Using plain aiohttp client
     with show_duration('aiohttp', extra_newline=True):
         async with aiohttp.ClientSession() as session:
-            async with session.get('https://www.google.com') as response:
+            async with session.get(url) as response:
                 content = await response.text()
                 print('Status:', response.status)   # 200
                 print('Length:', len(content))      # 10597
 
     # The above becomes a bit easier without indents using `aiohttp_requests`
     with show_duration('aiohttp_requests', extra_newline=True):
-        response = await requests.get('https://www.google.com')
+        response = await requests.get(url)
         content = await response.text()
         print('Status: ', response.status)          # 200
         print('Length: ', len(content))             # 10625
@@ -58,7 +142,7 @@ async def request():
     # Now, let's do some concurrent requests
     with show_duration('100 concurrent requests'):
         status_count = defaultdict(int)
-        get_futures = [requests.get('https://www.google.com')
+        get_futures = [requests.get(url)
                        for _ in range(1000)]
         for get_future in asyncio.as_completed(get_futures):
             response = await get_future
@@ -66,5 +150,1161 @@ async def request():
 
         print(status_count)                         # {200: 100}
 
+    # Better yet, share one session with limits so we don't open a
+    # connection for every request, and only fetch as fast as we can.
+    with show_duration('1000 requests with a shared session'):
+        status_count = defaultdict(int)
+        async with Fetcher(concurrency=100) as fetcher:
+            urls = [url] * 1000
+            async for response in fetcher.fetch_all(urls):
+                status_count[response.status] += 1
+
+        print(status_count)                         # {200: 1000}
+
+    # Identical requests at the same time can even share one request
+    with show_duration('1000 coalesced requests'):
+        async with Fetcher(coalesce=True) as fetcher:
+            responses = await asyncio.gather(*[fetcher.fetch(url)
+                                               for _ in range(1000)])
+            print(len(responses), 'responses from',
+                  len(responses) - fetcher.coalesced, 'request')
+
+    # For large responses, stream the body in chunks instead of reading it
+    # all into memory.
+    with show_duration('Streamed download'):
+        async with Fetcher() as fetcher:
+            hasher = ChunkHasher()
+            response = await fetcher.download(url, hasher)
+            print('Size:', response.size, 'SHA256:', hasher.hexdigest())
+
+
+#: Methods that are safe to retry
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+#: Errors that mean the server is overloaded, or can't be reached
+OVERLOAD_ERRORS = (asyncio.TimeoutError, aiohttp.ClientConnectionError)
+
+
+def is_overloaded(status):
+    """ Returns True if the HTTP status means the server is overloaded """
+    return status == 429 or status >= 500
+
+
+class Fetcher:
+    """
+    HTTP client that shares one session, and its pool of connections, for
+    all requests, with a limit on the number of requests at the same time.
+
+    .. code-block:: python
+
+        async with Fetcher(concurrency=100) as fetcher:
+            response = await fetcher.fetch('https://www.google.com')
+            print(response.status, len(response.body))
+
+            async for response in fetcher.fetch_all(urls):
+                print(response.url, response.status)
+
+    With a cache, GET responses are reused while fresh, and revalidated
+    with the server when stale, so an unchanged response costs a 304
+    without a body.
+
+    .. code-block:: python
+
+        async with Fetcher(cache=ResponseCache()) as fetcher:
+            ...
+
+    With an `AdaptiveLimit`, the number of requests at the same time grows
+    while the server keeps up, and is cut when it is overloaded. With a
+    `RetryPolicy`, failed requests are retried after a jittered backoff.
+
+    .. code-block:: python
+
+        async with Fetcher(adaptive=AdaptiveLimit(max_limit=200),
+                           retry=RetryPolicy()) as fetcher:
+            ...
+
+    With coalescing, identical GETs that are in flight at the same time
+    share one request, and all get the same response, so a burst of
+    requests to one URL costs one round trip.
+    """
+
+    def __init__(self, concurrency=100, limit_per_host=0, timeout=30,
+                 keepalive_timeout=30, dns_cache_ttl=300, cache=None,
+                 coalesce=False, adaptive=None, retry=None):
+        """
+        :param int concurrency: Max number of requests at the same time,
+                                which is also the max number of connections.
+        :param int limit_per_host: Max number of connections to the same
+                                   host. Defaults to no limit besides the
+                                   concurrency.
+        :param float timeout: Default number of seconds for a request to
+                              finish, including reading the body.
+        :param float keepalive_timeout: Number of seconds to keep an idle
+                                        connection open for reuse
+        :param int dns_cache_ttl: Number of seconds to cache DNS lookups
+        :param ResponseCache cache: Cache for GET responses
+        :param bool coalesce: Share one request for identical GETs that are
+                              in flight at the same time. Can be changed
+                              per request with `fetch(coalesce=...)`.
+        :param AdaptiveLimit adaptive: Adjust the number of requests at the
+                                       same time, up to its `max_limit`,
+                                       instead of a fixed concurrency.
+        :param RetryPolicy retry: Retry failed requests that are idempotent
+        """
+        #: Limit of requests at the same time. A fixed concurrency is an
+        #: adaptive limit that can't change.
+        self.limit = adaptive or AdaptiveLimit(concurrency, concurrency,
+                                               concurrency)
+        self.concurrency = int(self.limit.max_limit)
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+
+        #: Shared session, created when the fetcher is opened.
+        self.session = None
+
+        #: Cache for GET responses
+        self.cache = cache
+
+        #: Share one request for identical GETs in flight
+        self.coalesce = coalesce
+
+        #: Number of requests that shared an in-flight request
+        self.coalesced = 0
+
+        #: Policy to retry failed requests
+        self.retry = retry
+
+        # Map of request key to the task of the in-flight request
+        self._in_flight = {}
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def open(self):
+        """ Create the session. Needs to be called in the event loop. """
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency, limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        """ Close the session and its connections """
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, url, method='GET', timeout=None, coalesce=None,
+                    **kwargs):
+        """
+        Make a request and read the response.
+
+        :param str url: URL to request
+        :param str method: HTTP method
+        :param float timeout: Number of seconds for the request to finish.
+                              Defaults to the fetcher's timeout.
+        :param bool coalesce: Share the request with identical GETs in
+                              flight. Defaults to the fetcher's coalesce.
+        :param kwargs: Additional args for `aiohttp.ClientSession.request`
+        :return: Response with the body read. Coalesced requests get the
+                 same Response object.
+        """
+        if timeout:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+        if coalesce is None:
+            coalesce = self.coalesce
+        has_body = 'data' in kwargs or 'json' in kwargs
+        if not coalesce or method != 'GET' or has_body:
+            return await self._fetch(url, method, **kwargs)
+
+        key = _request_key(url, kwargs)
+        task = self._in_flight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._fetch(url, method, **kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(partial(self._finish_in_flight, key))
+
+        # Shield so one caller that is cancelled doesn't fail the others
+        return await asyncio.shield(task)
+
+    def _finish_in_flight(self, key, task):
+        del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved in case all callers were cancelled
+
+    async def _fetch(self, url, method, **kwargs):
+        """ Make a request using the cache for GETs """
+        if self.cache is None or method != 'GET':
+            return await self._request(method, url, **kwargs)
+
+        request_headers = CIMultiDict(kwargs.pop('headers', None) or {})
+        key = self.cache.cache_key(url, kwargs.get('params'),
+                                   request_headers)
+
+        cached = self.cache.get(key)
+        if cached and not cached.matches(request_headers):
+            cached = None
+
+        if cached and cached.is_fresh():
+            self.cache.hits += 1
+            return cached.response
+
+        headers = CIMultiDict(request_headers)
+        if cached:
+            headers.update(cached.validators())
+
+        response = await self._request(method, url, headers=headers,
+                                       **kwargs)
+
+        if cached and response.status == 304:
+            self.cache.revalidated += 1
+            self.cache.refresh(key, response.headers)
+            return cached.response
+
+        self.cache.misses += 1
+        self.cache.store(key, response, request_headers)
+        return response
+
+    async def _request(self, method, url, **kwargs):
+        """ Make a request, with retries, and read the response """
+        retry = self.retry if method in IDEMPOTENT_METHODS else None
+        if retry:
+            retry.deposit()
+
+        attempt = 0
+        while True:
+            try:
+                response = await self._request_once(method, url, **kwargs)
+
+            except OVERLOAD_ERRORS:
+                if not (retry and retry.can_retry(attempt)):
+                    raise
+                delay = retry.delay(attempt)
+
+            else:
+                failed = retry and response.status in retry.statuses
+                if not (failed and retry.can_retry(attempt)):
+                    return response
+                delay = retry.delay(attempt,
+                                    response.headers.get('Retry-After'))
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _request_once(self, method, url, **kwargs):
+        started = await self.limit.acquire()
+        overloaded = None
+        try:
+            async with self.session.request(method, url,
+                                            **kwargs) as response:
+                body = await response.read()
+                overloaded = is_overloaded(response.status)
+                return Response(str(response.url), response.status,
+                                response.headers, body)
+
+        except OVERLOAD_ERRORS:
+            overloaded = True
+            raise
+
+        finally:
+            self.limit.release(started, overloaded)
+
+    @asynccontextmanager
+    async def stream(self, url, method='GET', timeout=None, **kwargs):
+        """
+        Make a request without reading the body, so it can be read in chunks
+        from the `StreamedResponse`.
+
+        .. code-block:: python
+
+            async with fetcher.stream(url) as response:
+                async for chunk in response.iter_chunks():
+                    ...
+
+        :param str url: URL to request
+        :param str method: HTTP method
+        :param float timeout: Number of seconds for the request to finish.
+                              Defaults to the fetcher's timeout.
+        :param kwargs: Additional args for `aiohttp.ClientSession.request`
+        """
+        if timeout:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+        started = await self.limit.acquire()
+        overloaded = None
+        try:
+            async with self.session.request(method, url,
+                                            **kwargs) as response:
+                overloaded = is_overloaded(response.status)
+                yield StreamedResponse(response)
+
+        except OVERLOAD_ERRORS:
+            overloaded = True
+            raise
+
+        finally:
+            self.limit.release(started, overloaded)
+
+    async def download(self, url, handler, chunk_size=64 * 1024,
+                       encoding=None, **kwargs):
+        """
+        Stream the body of the response to the handler in chunks, so memory
+        stays the same regardless of the size of the body.
+
+        :param str url: URL to request
+        :param handler: Callable, or coroutine function, called with each
+                        chunk, such as `ChunkHasher`, `ChunkWriter` or
+                        `LineSplitter`. Its `close()` is called, if any,
+                        after the last chunk, or when the download fails.
+        :param int chunk_size: Max number of bytes per chunk
+        :param str encoding: Decode chunks to str with the encoding.
+                             Use 'auto' for the charset of the response.
+        :param kwargs: Additional args for `stream`
+        :return: StreamedResponse with the number of bytes read as `size`
+        """
+        try:
+            async with self.stream(url, **kwargs) as response:
+                async for chunk in response.iter_chunks(chunk_size,
+                                                        encoding):
+                    result = handler(chunk)
+                    if asyncio.iscoroutine(result):
+                        await result
+
+        finally:
+            # Close even if the download failed, so files are not left open
+            close = getattr(handler, 'close', None)
+            if close:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+
+        return response
+
+    async def fetch_all(self, urls, return_exceptions=False, **kwargs):
+        """
+        Fetch the URLs and yield the responses as they finish.
+
+        Only twice the concurrency of requests are started ahead of time,
+        so memory stays the same regardless of the number of URLs.
+
+        :param urls: Iterable of URLs to fetch
+        :param bool return_exceptions: Yield the error for a failed request
+                                       instead of raising it
+        :param kwargs: Additional args for `fetch`
+        """
+        window = self.concurrency * 2
+        started = set()
+
+        async def wait_for_next():
+            done, _ = await asyncio.wait(started,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            started.difference_update(done)
+            for task in done:
+                if task.exception() and not return_exceptions:
+                    raise task.exception()
+            return [task.exception() or task.result() for task in done]
+
+        try:
+            for url in urls:
+                if len(started) >= window:
+                    for response in await wait_for_next():
+                        yield response
+
+                started.add(asyncio.ensure_future(self.fetch(url, **kwargs)))
+
+            while started:
+                for response in await wait_for_next():
+                    yield response
+
+        finally:
+            for task in started:
+                task.cancel()
+
+
+class AdaptiveLimit:
+    """
+    Limit of requests at the same time that adjusts to the server using
+    additive increase / multiplicative decrease (AIMD), like TCP congestion
+    control.
+
+    Each healthy response raises the limit by `increase / limit`, so about
+    `increase` per round of requests. An overloaded response (429, 5xx,
+    timeout, connection error, or slower than the latency target) cuts the
+    limit by the `decrease` factor, at most once per round, as requests that
+    were already in flight when the limit was cut are not the cause.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100, increase=1,
+                 decrease=0.5, latency_target=None):
+        """
+        :param float initial: Limit to start with
+        :param float min_limit: Lowest the limit can be cut to
+        :param float max_limit: Highest the limit can grow to
+        :param float increase: Number to grow the limit by per round
+        :param float decrease: Factor to cut the limit by when overloaded
+        :param float latency_target: Number of seconds a response should
+                                     take. Slower ones cut the limit.
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+
+        #: Number of requests in flight
+        self.in_flight = 0
+
+        #: Number of times the limit was cut
+        self.decreases = 0
+
+        self._waiters = deque()
+        self._last_decrease = 0
+
+    def __repr__(self):
+        return '<AdaptiveLimit {:.1f} ({} in flight)>'.format(
+            self.limit, self.in_flight)
+
+    async def acquire(self):
+        """
+        Wait for the limit to allow another request.
+
+        :return: Time the request started, to pass to `release`
+        """
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return monotonic()
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Cancelled after `_wake` gave it the slot, so pass it on
+                self.in_flight -= 1
+                self._wake()
+            raise
+
+        return monotonic()
+
+    def release(self, started, overloaded=False):
+        """
+        Finish a request and adjust the limit.
+
+        :param float started: Time from `acquire`
+        :param bool overloaded: If the server was overloaded, or None to
+                                not adjust the limit, such as when the
+                                request was cancelled.
+        """
+        self.in_flight -= 1
+
+        if overloaded is not None:
+            now = monotonic()
+            if self.latency_target and now - started > self.latency_target:
+                overloaded = True
+
+            if not overloaded:
+                self.limit = min(self.max_limit,
+                                 self.limit + self.increase / self.limit)
+
+            elif started >= self._last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = now
+                self.decreases += 1
+
+        self._wake()
+
+    def _wake(self):
+        """ Give free slots to the requests waiting the longest """
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class RetryPolicy:
+    """
+    Policy to retry failed requests with exponential backoff and full
+    jitter, so retries from many clients are spread out instead of hitting
+    the server at the same time.
+
+    Retries are limited by a budget that grows by `budget_ratio` of a retry
+    for each request, so retries stay a fraction of requests and can't
+    multiply the load on a server that is already failing.
+    """
+
+    def __init__(self, retries=3, backoff=0.1, max_backoff=10,
+                 budget_ratio=0.1, max_budget=10,
+                 statuses=(429, 500, 502, 503, 504)):
+        """
+        :param int retries: Max number of retries per request
+        :param float backoff: Number of seconds to wait before the first
+                              retry, which doubles for each retry after.
+        :param float max_backoff: Max number of seconds to wait
+        :param float budget_ratio: Number of retries earned per request
+        :param float max_budget: Max number of retries that can be saved
+                                 up, and what the budget starts with.
+        :param statuses: HTTP statuses to retry
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget_ratio = budget_ratio
+        self.max_budget = max_budget
+        self.statuses = set(statuses)
+
+        #: Number of retries left in the budget
+        self.budget = float(max_budget)
+
+        #: Number of retries made
+        self.retried = 0
+
+        #: Number of retries skipped as the budget ran out
+        self.exhausted = 0
+
+    def deposit(self):
+        """ Earn part of a retry for a new request """
+        self.budget = min(self.max_budget, self.budget + self.budget_ratio)
+
+    def can_retry(self, attempt):
+        """
+        Returns True if the request can be retried, and takes the retry
+        from the budget.
+
+        :param int attempt: Number of retries made for the request so far
+        """
+        if attempt >= self.retries:
+            return False
+
+        if self.budget < 1:
+            self.exhausted += 1
+            return False
+
+        self.budget -= 1
+        self.retried += 1
+        return True
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns the number of seconds to wait before the retry.
+
+        :param int attempt: Number of retries made for the request so far
+        :param str retry_after: Retry-After header from the server, which
+                                is waited for if it is longer.
+        """
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass  # No header, or a date that we don't bother with
+
+        return min(delay, self.max_backoff)
+
+
+class Response:
+    """ Response to a request with the body read """
+
+    def __init__(self, url, status, headers, body):
+        """
+        :param str url: URL of the response
+        :param int status: HTTP status code
+        :param headers: Response headers
+        :param bytes body: Response body
+        """
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return '<Response [{}] {}>'.format(self.status, self.url)
+
+    def text(self, encoding=None):
+        """ Returns the body decoded using the charset of the response """
+        return self.body.decode(encoding or _charset(self.headers),
+                                errors='replace')
+
+
+class StreamedResponse:
+    """ Response to a request with the body read in chunks """
+
+    def __init__(self, response):
+        """
+        :param aiohttp.ClientResponse response: Response to read from
+        """
+        self.url = str(response.url)
+        self.status = response.status
+        self.headers = response.headers
+
+        #: Number of bytes of the body read so far
+        self.size = 0
+
+        self._response = response
+
+    def __repr__(self):
+        return '<StreamedResponse [{}] {}>'.format(self.status, self.url)
+
+    async def iter_chunks(self, chunk_size=64 * 1024, encoding=None):
+        """
+        Yield the body in chunks of up to `chunk_size` bytes.
+
+        :param int chunk_size: Max number of bytes per chunk
+        :param str encoding: Decode chunks to str with the encoding.
+                             Use 'auto' for the charset of the response.
+                             Characters split between chunks are decoded
+                             with the next chunk.
+        """
+        decoder = None
+        if encoding:
+            if encoding == 'auto':
+                encoding = _charset(self.headers)
+            decoder = codecs.getincrementaldecoder(encoding)(
+                errors='replace')
+
+        async for chunk in self._response.content.iter_chunked(chunk_size):
+            self.size += len(chunk)
+            if decoder:
+                chunk = decoder.decode(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+
+        if decoder:
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+
+
+class ChunkHasher:
+    """ Chunk handler that hashes the body """
+
+    def __init__(self, name='sha256'):
+        """
+        :param str name: Name of the hash algorithm in `hashlib`
+        """
+        self._hash = hashlib.new(name)
+
+    def __call__(self, chunk):
+        self._hash.update(chunk)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class ChunkWriter:
+    """ Chunk handler that writes the body to a file """
+
+    def __init__(self, path):
+        """
+        :param str path: Path to write to. Chunks decoded to str are written
+                         as UTF-8.
+        """
+        self.path = path
+        self._file = None
+
+    def __call__(self, chunk):
+        if not self._file:
+            if isinstance(chunk, str):
+                self._file = open(self.path, 'w', encoding='utf-8',
+                                  newline='')
+            else:
+                self._file = open(self.path, 'wb')
+        self._file.write(chunk)
+
+    def close(self):
+        if not self._file:
+            open(self.path, 'wb').close()  # Empty body
+        else:
+            self._file.close()
+            self._file = None
+
+
+class LineSplitter:
+    """ Chunk handler that calls a callback with each line of the body """
+
+    def __init__(self, callback):
+        """
+        :param callback: Called with each line, without the line ending
+        """
+        self.callback = callback
+        self._partial = None
+
+    def __call__(self, chunk):
+        if self._partial:
+            chunk = self._partial + chunk
+
+        # Only split on '\n' so text and bytes give the same lines, as
+        # str.splitlines also splits on characters like '\x0c' and '\u2028'.
+        lines = chunk.split('\n' if isinstance(chunk, str) else b'\n')
+
+        # The last line may continue in the next chunk
+        self._partial = lines.pop()
+
+        for line in lines:
+            self.callback(_strip_cr(line))
+
+    def close(self):
+        if self._partial:
+            self.callback(_strip_cr(self._partial))
+            self._partial = None
+
+
+def _strip_cr(line):
+    """ Returns the line without a trailing '\r' from a '\r\n' ending """
+    return line[:-1] if line[-1:] in ('\r', b'\r') else line
+
+
+def _request_key(url, kwargs):
+    """ Returns a key that is the same for identical requests """
+    headers = sorted((str(k).lower(), str(v)) for k, v in
+                     (kwargs.get('headers') or {}).items())
+    others = sorted((k, repr(v)) for k, v in kwargs.items()
+                    if k not in ('headers', 'timeout'))
+    return url, tuple(headers), tuple(others)
+
+
+def _charset(headers):
+    """ Returns the charset of the response, defaulting to UTF-8 """
+    content_type = headers.get('Content-Type', '')
+    if 'charset=' in content_type:
+        return content_type.split('charset=')[-1].split(';')[0].strip()
+    return 'utf-8'
+
+
+class ResponseCache:
+    """
+    Cache of responses in memory, and optionally on disk, that follows the
+    Cache-Control and Expires headers.
+
+    Memory is limited to `max_bytes` by evicting the least recently used
+    responses. With a cache dir, responses are also saved to disk and loaded
+    back when they are evicted from memory.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, cache_dir=None):
+        """
+        :param int max_bytes: Max number of bytes of responses in memory
+        :param str cache_dir: Dir to also save responses to
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+
+        #: Number of bytes of responses in memory
+        self.size = 0
+
+        #: Number of fresh responses returned from the cache
+        self.hits = 0
+
+        #: Number of stale responses that the server said are unchanged
+        self.revalidated = 0
+
+        #: Number of responses that were not cached or changed
+        self.misses = 0
+
+        # Map of key to CachedResponse, from least to most recently used
+        self._entries = OrderedDict()
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def cache_key(url, params=None, headers=None):
+        """
+        Returns the key to cache the response of a request by: the full URL
+        with the query, and the Authorization header so responses for one
+        user are never reused for another.
+
+        :param str url: URL of the request
+        :param params: Query params of the request
+        :param headers: Headers of the request
+        """
+        key = str(URL(url).extend_query(params) if params else URL(url))
+
+        authorization = (headers or {}).get('Authorization')
+        if authorization:
+            digest = hashlib.sha256(authorization.encode()).hexdigest()
+            key += ' ' + digest
+
+        return key
+
+    def get(self, key):
+        """
+        Returns the CachedResponse for the key, or None if missing.
+
+        :param str key: Key of the request from `cache_key`
+        """
+        cached = self._entries.get(key)
+        if cached:
+            self._entries.move_to_end(key)
+
+        elif self.cache_dir:
+            try:
+                with open(self._path(key), 'rb') as fp:
+                    cached = pickle.load(fp)
+            except (OSError, pickle.PickleError, EOFError):
+                return None
+            self._add(key, cached)
+
+        return cached
+
+    def store(self, key, response, request_headers=None):
+        """
+        Cache the response if it can be.
+
+        :param str key: Key of the request from `cache_key`
+        :param Response response: Response to cache
+        :param request_headers: Headers of the request, to only reuse the
+                                response for requests with the same values
+                                of the headers in its Vary header.
+        """
+        expires = _expires(response.headers)
+        if response.status != 200 or expires is None:
+            self.remove(key)
+            return
+
+        cached = CachedResponse(response, expires, request_headers)
+        if not (cached.is_fresh() or cached.validators()):
+            self.remove(key)
+            return
+
+        self._add(key, cached)
+        self._save(key, cached)
+
+    def refresh(self, key, headers):
+        """ Update when the cached response expires from a 304 response """
+        cached = self._entries.get(key)
+        if cached:
+            cached.expires = _expires(headers) or time()
+            self._save(key, cached)
+
+    def remove(self, key):
+        """ Remove the response for the key """
+        cached = self._entries.pop(key, None)
+        if cached:
+            self.size -= cached.size
+
+        if self.cache_dir:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _add(self, key, cached):
+        if key in self._entries:
+            self.size -= self._entries.pop(key).size
+
+        self._entries[key] = cached
+        self.size += cached.size
+
+        while self.size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def _save(self, key, cached):
+        if self.cache_dir:
+            # Write to a temp file first so readers never see a partial one
+            path = self._path(key)
+            with open(path + '.tmp', 'wb') as fp:
+                pickle.dump(cached, fp)
+            os.replace(path + '.tmp', path)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+
+class CachedResponse:
+    """ Response in the cache and when it expires """
+
+    def __init__(self, response, expires, request_headers=None):
+        """
+        :param Response response: Response to cache
+        :param float expires: Timestamp when the response is stale
+        :param request_headers: Headers of the request
+        """
+        # Plain headers so they can be pickled
+        self.response = Response(response.url, response.status,
+                                 CIMultiDict(response.headers),
+                                 response.body)
+        self.expires = expires
+
+        #: Values of the request headers named in the Vary header, which
+        #: need to be the same for the response to be reused.
+        request_headers = CIMultiDict(request_headers or {})
+        self.vary = {name: request_headers.get(name)
+                     for name in _vary(response.headers)}
+
+        #: Rough number of bytes used by the response
+        self.size = len(response.body) + sum(
+            len(k) + len(v) for k, v in response.headers.items())
+
+    def is_fresh(self):
+        """ Returns True if the response can be used without checking """
+        return time() < self.expires
+
+    def matches(self, request_headers):
+        """ Returns True if the response can be used for the request """
+        request_headers = CIMultiDict(request_headers or {})
+        return all(request_headers.get(name) == value
+                   for name, value in self.vary.items())
+
+    def validators(self):
+        """ Returns headers to ask the server if the response changed """
+        headers = {}
+        if 'ETag' in self.response.headers:
+            headers['If-None-Match'] = self.response.headers['ETag']
+        if 'Last-Modified' in self.response.headers:
+            headers['If-Modified-Since'] = self.response.headers[
+                'Last-Modified']
+        return headers
+
+
+def _vary(headers):
+    """ Returns the lowercase names of the headers in the Vary header """
+    names = headers.get('Vary', '').split(',')
+    return [name.strip().lower() for name in names if name.strip()]
+
+
+def _expires(headers):
+    """
+    Returns when a response with the headers expires, or None if it should
+    not be cached.
+    """
+    directives = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().lower().partition('=')
+        directives[name] = value.strip('"')
+
+    if 'no-store' in directives or headers.get('Vary') == '*':
+        return None
+
+    now = time()
+    if 'no-cache' in directives:
+        return now  # Cache, but always revalidate
+
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return now + int(directives[name])
+            except ValueError:
+                return now
+
+    if 'Expires' in headers:
+        try:
+            expires = parsedate_to_datetime(headers['Expires']).timestamp()
+        except (TypeError, ValueError):
+            return now  # Invalid dates mean already expired
+
+        # Relative to the server's clock in case ours is off
+        if 'Date' in headers:
+            try:
+                expires += now - parsedate_to_datetime(
+                    headers['Date']).timestamp()
+            except (TypeError, ValueError):
+                pass
+
+        return expires
+
+    return now
+
+
+class LocalServer:
+    """
+    Local HTTP server to stand in for a real one, so requests can be made
+    offline and benchmarked without noise from the internet.
+
+    Each request can change the defaults with query params, such as
+    `/?latency=0.1&size=100&error_rate=0.5`.
+
+    .. code-block:: python
+
+        async with LocalServer(latency=0.05) as server:
+            await fetcher.fetch(server.url)
+    """
+
+    def __init__(self, latency=0.01, body_size=10000, error_rate=0,
+                 error_status=503, host='127.0.0.1', port=0):
+        """
+        :param float latency: Number of seconds to wait before responding
+        :param int body_size: Number of bytes in the response body
+        :param float error_rate: Ratio of requests, from 0 to 1, that fail
+        :param int error_status: HTTP status of failed requests
+        :param str host: Host to listen on
+        :param int port: Port to listen on. Defaults to a free port.
+        """
+        self.latency = latency
+        self.body_size = body_size
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.host = host
+        self.port = port
+
+        #: URL of the server once started
+        self.url = None
+
+        self._runner = None
+        self.reset()
+
+    def reset(self):
+        """ Reset the stats """
+        #: Number of requests handled
+        self.requests = 0
+
+        #: Number of requests that failed on purpose
+        self.errors = 0
+
+        #: Number of requests being handled
+        self.active = 0
+
+        #: Max number of requests handled at the same time
+        self.max_active = 0
+
+        #: Client addresses of the connections, one per socket
+        self.peers = set()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self):
+        """ Start the server and return its URL """
+        app = aiohttp.web.Application()
+        app.router.add_route('*', '/{path:.*}', self._handle)
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = aiohttp.web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+
+        host, port = self._runner.addresses[0][:2]
+        self.url = 'http://{}:{}/'.format(host, port)
+        return self.url
+
+    async def stop(self):
+        """ Stop the server """
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.peers.add(request.transport.get_extra_info('peername'))
+
+        try:
+            query = request.query
+            await asyncio.sleep(float(query.get('latency', self.latency)))
+
+            error_rate = float(query.get('error_rate', self.error_rate))
+            if error_rate and random.random() < error_rate:
+                self.errors += 1
+                return aiohttp.web.Response(status=self.error_status)
+
+            size = int(query.get('size', self.body_size))
+            return aiohttp.web.Response(body=b'x' * size)
+
+        finally:
+            self.active -= 1
+
+
+def benchmark(levels=(10, 50, 100, 200), requests=2000, latency=0.01,
+              body_size=10000, error_rate=0):
+    """
+    Make requests to a `LocalServer` at each level of concurrency, and print
+    the results as JSON.
+
+    :param levels: Numbers of requests at the same time to try
+    :param int requests: Number of requests to make for each level
+    :param float latency: Number of seconds for the server to respond
+    :param int body_size: Number of bytes in each response body
+    :param float error_rate: Ratio of requests that the server fails
+    :return: Results for each level
+    """
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(_benchmark(
+        levels, requests, latency, body_size, error_rate))
+
+    print(json.dumps({
+        'server': {'latency': latency, 'body_size': body_size,
+                   'error_rate': error_rate},
+        'results': results}, indent=2))
+    return results
+
+
+async def _benchmark(levels, requests, latency, body_size, error_rate):
+    results = []
+    async with LocalServer(latency, body_size, error_rate) as server:
+        for concurrency in levels:
+            server.reset()
+            results.append(await _benchmark_level(server, concurrency,
+                                                  requests))
+    return results
+
+
+async def _benchmark_level(server, concurrency, requests):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def work():
+        nonlocal errors
+        for _ in remaining:
+            start_time = perf_counter()
+            try:
+                response = await fetcher.fetch(server.url)
+                if response.status >= 400:
+                    errors += 1
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                errors += 1
+            latencies.append(perf_counter() - start_time)
+
+    start_time = perf_counter()
+    async with Fetcher(concurrency=concurrency) as fetcher:
+        await asyncio.gather(*[work() for _ in range(concurrency)])
+    duration = perf_counter() - start_time
+
+    latencies.sort()
+
+    def percentile(ratio):
+        return round(latencies[int(ratio * (len(latencies) - 1))] * 1000, 2)
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'seconds': round(duration, 3),
+        'requests_per_second': round(requests / duration, 1),
+        'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95),
+                       'p99': percentile(0.99)},
+        'sockets': len(server.peers),
+        'max_in_flight': server.max_active,
+    }
+
+
 if __name__ == "__main__":
-    main()
+    if '--benchmark' in sys.argv:
+        benchmark()
+    else:
+        main(local='--local' in sys.argv)
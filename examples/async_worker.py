@@ -17,12 +17,39 @@ Done with Task 1 after 2 seconds!
 [0 running tasks]
 Done with Task 0 after 3 seconds!
 
+$ python3 async_worker.py --benchmark
+Worker pool ran 1000000 jobs in 2.74 seconds (max RSS 19 MB)
+Creating all at once ran 1000000 jobs in 15.76 seconds (max RSS 853 MB)
+Submitted 1500 jobs/second for 10 workers that can run 1000 jobs/second:
+  Priority 0: 435 jobs, p50 11 ms, p99 12 ms
+  Priority 1: 3795 jobs, p50 902 ms, p99 1530 ms
+  Dropped 0 jobs that missed their deadline
+1 shards: 6892 jobs/second
+Task per job: 46727 jobs/second
+Batches of 1: 26328 jobs/second
+Batches of 10: 98458 jobs/second
+Batches of 100: 128844 jobs/second
+Batches of 1000: 143915 jobs/second
+
 References
 -----------------------------------------------------------------------------
 https://docs.python.org/3/library/asyncio.html
 """
 
 import asyncio
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import count
+from multiprocessing import Process
+import os
+import pickle
+import random
+import resource
+import socket
+import struct
+import sys
+from time import perf_counter
 
 
 def main():
@@ -40,21 +67,274 @@ class AsyncManager:
 
         manager = AsyncManager(3)
         asyncio.run_until_complete(manager.do_things_concurrently())
+
+    Blocking functions would stop the event loop from running anything else,
+    so they are run in a thread pool (for blocking I/O) or process pool (for
+    CPU work) instead. Small CPU jobs are sent to the process pool in
+    batches to save on the cost of sending each one to another process.
+
+    .. code-block:: python
+
+        jobs = [manager.cpu(sum, range(n)) for n in range(1000)]
+        count = await manager.process(jobs, workers=100)
+        manager.close()
+
+    Jobs can also be submitted with a priority and a deadline to start by.
+    Jobs wait in a heap ordered by priority, where every `aging` seconds of
+    waiting counts as one level of priority so that low priority jobs still
+    run when there is a steady stream of higher priority ones.
+
+    .. code-block:: python
+
+        urgent = manager.submit(job, priority=0, deadline=0.5)
+        bulk = manager.submit(job, priority=5)
+        await urgent   # Raises asyncio.TimeoutError if not started in 0.5s
+
+    When jobs are tiny, the cost of running each one adds up, so they can be
+    batched instead and handled together by a function that takes a list.
+
+    .. code-block:: python
+
+        async def double_all(numbers):
+            return [n * 2 for n in numbers]
+
+        double = manager.batcher(double_all, max_size=100)
+        await double(21)   # 42, but computed along with other numbers
     """
 
     # Number of seconds to finish a task
     _TASK_DURATION = 1
 
-    def __init__(self, tasks):
+    def __init__(self, tasks, progress_interval=0, threads=None,
+                 processes=None, cpu_batch_size=32, aging=1):
         """
         :param int tasks: Number of concurrent tasks to run
+        :param float progress_interval: Min number of seconds between
+                                        showing progress, so frequent changes
+                                        are combined into one update.
+        :param int threads: Number of threads to run blocking jobs in.
+                            Defaults to number of CPUs + 4, up to 32.
+        :param int processes: Number of processes to run CPU jobs in.
+                              Defaults to the number of CPUs.
+        :param int cpu_batch_size: Max number of CPU jobs to send to a
+                                   process at once
+        :param float aging: Number of seconds a submitted job waits for its
+                            priority to go up by one level
         """
         #: Number of tasks to run concurrently.
         self.tasks = tasks
 
+        #: Min number of seconds between showing progress.
+        self.progress_interval = progress_interval
+
         # Number of currently running tasks.
         self._running_tasks = 0
 
+        # Set when the number of running tasks changes, so progress is only
+        # shown when there is something new to show.
+        self._tasks_changed = asyncio.Event()
+
+        cpus = os.cpu_count() or 1
+
+        #: Number of threads to run blocking jobs in.
+        self.threads = threads or min(32, cpus + 4)
+
+        #: Number of processes to run CPU jobs in.
+        self.processes = processes or cpus
+
+        #: Max number of CPU jobs to send to a process at once.
+        self.cpu_batch_size = cpu_batch_size
+
+        #: Number of batches sent to the process pool.
+        self.cpu_batches = 0
+
+        # Pools are created when first used
+        self._thread_pool = None
+        self._process_pool = None
+
+        # CPU jobs waiting to be sent: [(func, args)] and their futures
+        self._cpu_jobs = []
+        self._cpu_futures = []
+
+        #: Number of seconds a job waits for its priority to go up by one.
+        self.aging = aging
+
+        #: Number of submitted jobs dropped for missing their deadline.
+        self.expired_jobs = 0
+
+        # Submitted jobs ready to run and the workers that run them. Created
+        # when the first job is submitted.
+        self._ready_jobs = None
+        self._workers = []
+        self._sequence = count()
+
+    def submit(self, job, priority=0, deadline=None):
+        """
+        Submit the job to run when a worker is free, ahead of jobs with
+        lower priority. There are `tasks` workers.
+
+        :param job: Function that returns a coroutine (or other awaitable)
+        :param int priority: Jobs with lower numbers run first
+        :param float deadline: Number of seconds from now the job has to
+                               start by, or it is dropped.
+        :return: Future for the result of the job
+        """
+        loop = asyncio.get_event_loop()
+
+        if self._ready_jobs is None:
+            self._ready_jobs = asyncio.PriorityQueue()
+            self._workers = [asyncio.ensure_future(self._work())
+                             for _ in range(self.tasks)]
+
+        # Waiting for `aging` seconds is the same as going up one level, so
+        # the order is fixed when submitted and a heap can be used.
+        now = loop.time()
+        rank = now + priority * self.aging
+        expires = None if deadline is None else now + deadline
+
+        future = loop.create_future()
+        self._ready_jobs.put_nowait((rank, next(self._sequence), expires,
+                                     job, future))
+        return future
+
+    async def _work(self):
+        """ Run submitted jobs, skipping those past their deadline """
+        loop = asyncio.get_event_loop()
+
+        while True:
+            _, _, expires, job, future = await self._ready_jobs.get()
+            if future.cancelled():
+                continue
+
+            if expires is not None and loop.time() > expires:
+                self.expired_jobs += 1
+                future.set_exception(asyncio.TimeoutError(
+                    'Deadline passed before the job started'))
+                continue
+
+            self._add_running_tasks(1)
+            try:
+                # Cancelling the future from `submit` cancels the running
+                # job. Calling the job may fail, which fails the future.
+                task = asyncio.ensure_future(job())
+                future.add_done_callback(partial(_cancel_job, task))
+
+                result = await task
+                if not future.done():
+                    future.set_result(result)
+
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # The worker was cancelled, not just the job
+                    future.cancel()
+                    raise
+
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+            finally:
+                self._add_running_tasks(-1)
+
+    def blocking(self, func, *args, **kwargs):
+        """
+        Returns a job that runs the blocking function in a thread, such as
+        for `process`.
+
+        :param callable func: Function to call with the args
+        """
+        return partial(self.run_blocking, func, *args, **kwargs)
+
+    def cpu(self, func, *args, **kwargs):
+        """
+        Returns a job that runs the CPU bound function in another process,
+        such as for `process`. The function and args need to be picklable.
+
+        :param callable func: Function to call with the args
+        """
+        return partial(self.run_cpu, func, *args, **kwargs)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """ Run the blocking function in a thread and return its result """
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(self.threads)
+
+        return await asyncio.get_event_loop().run_in_executor(
+            self._thread_pool, partial(func, *args, **kwargs))
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """
+        Run the CPU bound function in another process and return its
+        result.
+
+        Calls made at about the same time are sent together in one batch.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        self._cpu_jobs.append((func, args, kwargs))
+        self._cpu_futures.append(future)
+
+        if len(self._cpu_jobs) >= self.cpu_batch_size:
+            self._send_cpu_jobs()
+        elif len(self._cpu_jobs) == 1:
+            # Wait for other jobs submitted in this loop iteration
+            loop.call_soon(self._send_cpu_jobs)
+
+        return await future
+
+    def _send_cpu_jobs(self):
+        """ Send waiting CPU jobs to the process pool as one batch """
+        if not self._cpu_jobs:
+            return
+
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(self.processes)
+
+        jobs, futures = self._cpu_jobs, self._cpu_futures
+        self._cpu_jobs, self._cpu_futures = [], []
+        self.cpu_batches += 1
+
+        batch = asyncio.get_event_loop().run_in_executor(
+            self._process_pool, _run_batch, jobs)
+        batch.add_done_callback(partial(_set_results, futures))
+
+    def batcher(self, handler, max_size=100, max_linger=0.001):
+        """
+        Returns a `Batcher` that collects items to handle them in batches.
+
+        :param handler: Async function that takes a list of items and
+                        returns a list of their results in the same order
+        :param int max_size: Max number of items in a batch
+        :param float max_linger: Max number of seconds to wait for more
+                                 items before handling a batch
+        """
+        return Batcher(handler, max_size, max_linger,
+                       on_change=self._add_running_tasks)
+
+    def close(self):
+        """ Stop running submitted jobs and shut down the pools """
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+        while self._ready_jobs and not self._ready_jobs.empty():
+            self._ready_jobs.get_nowait()[-1].cancel()
+        self._ready_jobs = None
+
+        if self._thread_pool:
+            self._thread_pool.shutdown()
+            self._thread_pool = None
+
+        if self._process_pool:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def _add_running_tasks(self, count):
+        """ Add to the number of running tasks and notify of the change """
+        self._running_tasks += count
+        self._tasks_changed.set()
+
     async def _run_background_task(self, name, delay_multiplier=1):
         """
         Run a task in the background
@@ -64,13 +344,13 @@ class AsyncManager:
                                      multiplier for final task duration for
                                      the worker
         """
-        self._running_tasks += 1
+        self._add_running_tasks(1)
         task_duration = self._TASK_DURATION * delay_multiplier
 
         print('Running "{}"'.format(name))
         await asyncio.sleep(task_duration)  # Best way to pretend to do work!
 
-        self._running_tasks -= 1
+        self._add_running_tasks(-1)
         return 'Done with {n} after {d} seconds!'.format(n=name,
                                                          d=task_duration)
 
@@ -95,18 +375,687 @@ class AsyncManager:
 
         show_task.cancel()  # Terminate the background task
 
+    async def process(self, jobs, workers=None, queue_size=None,
+                      on_result=None):
+        """
+        Run jobs from the given iterable using a fixed number of workers.
+
+        Jobs are pulled from the iterable only as fast as the workers finish
+        them, so memory stays the same regardless of the number of jobs.
+
+        .. code-block:: python
+
+            async def job():
+                return 'done'
+
+            manager = AsyncManager(10)
+            count = await manager.process(job for _ in range(1000000))
+
+        :param jobs: Iterable or async iterable of jobs. Each job is a
+                     function that returns a coroutine (or other awaitable).
+        :param int workers: Number of jobs to run at the same time.
+                            Defaults to `tasks`.
+        :param int queue_size: Max number of jobs waiting for a worker.
+                               Defaults to twice the number of workers.
+        :param callable on_result: Called with the result of each job
+        :return: Number of jobs run
+        """
+        workers = workers or self.tasks
+        queue = asyncio.Queue(queue_size or workers * 2)
+        done = 0
+
+        async def produce():
+            async for job in _aiter(jobs):
+                await queue.put(job)  # Waits while the queue is full
+
+            for _ in range(workers):
+                await queue.put(None)  # Tell each worker to stop
+
+        async def work():
+            nonlocal done
+
+            while True:
+                job = await queue.get()
+                if job is None:
+                    return
+
+                result = await self._run_job(job)
+                done += 1
+                if on_result:
+                    on_result(result)
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks.extend(asyncio.ensure_future(work()) for _ in range(workers))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Stop the rest when a job fails
+            for task in tasks:
+                task.cancel()
+
+        return done
+
+    async def results(self, jobs, ordered=False, window=None):
+        """
+        Run jobs from the given iterable and yield their results as they
+        finish, or in the same order as the jobs when ordered.
+
+        At most `window` jobs are started but not yet yielded, so memory
+        stays the same regardless of the number of jobs. When ordered, a
+        slow job holds back the results after it until it finishes, and no
+        new jobs start once the window is full.
+
+        .. code-block:: python
+
+            async for result in manager.results(jobs, ordered=True):
+                print(result)
+
+        :param jobs: Iterable or async iterable of jobs. Each job is a
+                     function that returns a coroutine (or other awaitable).
+        :param bool ordered: Yield results in the same order as the jobs
+        :param int window: Max number of jobs started but not yet yielded.
+                           Defaults to `tasks`.
+        """
+        window = window or self.tasks
+
+        # Running or finished jobs that are not yet yielded, in the order
+        # they were started when ordered.
+        started = deque() if ordered else set()
+
+        try:
+            async for job in _aiter(jobs):
+                if len(started) >= window:
+                    if ordered:
+                        yield await started.popleft()
+                    else:
+                        for result in await self._next_done(started):
+                            yield result
+
+                task = asyncio.ensure_future(self._run_job(job))
+                if ordered:
+                    started.append(task)
+                else:
+                    started.add(task)
+
+            while started:
+                if ordered:
+                    yield await started.popleft()
+                else:
+                    for result in await self._next_done(started):
+                        yield result
+
+        finally:
+            # Stop the rest when a job fails or the caller stops early
+            for task in started:
+                task.cancel()
+
+    @staticmethod
+    async def _next_done(started):
+        """ Wait for jobs to finish and return their results """
+        done, _ = await asyncio.wait(started,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        started.difference_update(done)
+        return [task.result() for task in done]
+
+    async def _run_job(self, job):
+        """ Run the job while counting it as running """
+        self._add_running_tasks(1)
+        try:
+            return await job()
+        finally:
+            self._add_running_tasks(-1)
+
     async def _show_running_tasks(self):
-        """ Show # of tasks running in the background """
+        """ Show # of tasks running in the background when it changes """
         last_running_tasks = None
 
         while True:
+            # Clear before checking so a change after the check is not missed
+            self._tasks_changed.clear()
+
             if last_running_tasks != self._running_tasks:
                 print("[{} running tasks]".format(self._running_tasks))
                 last_running_tasks = self._running_tasks
 
-            # Let other coroutines do work instead of blocking
-            await asyncio.sleep(0)
+                # Changes while sleeping are shown together afterwards
+                if self.progress_interval:
+                    await asyncio.sleep(self.progress_interval)
+                continue
+
+            # Sleep until there is a change instead of checking constantly,
+            # which would leave no time for other coroutines to do work.
+            await self._tasks_changed.wait()
+
+
+class Batcher:
+    """
+    Collects items until there are `max_size` of them or `max_linger`
+    seconds have passed since the first one, and then handles them together
+    with one call to the handler.
+
+    .. code-block:: python
+
+        batcher = Batcher(save_rows, max_size=500)
+        await batcher(row)   # Result of saving the row
+    """
+
+    def __init__(self, handler, max_size=100, max_linger=0.001,
+                 on_change=None):
+        """
+        :param handler: Async function that takes a list of items and
+                        returns a list of their results in the same order
+        :param int max_size: Max number of items in a batch
+        :param float max_linger: Max number of seconds to wait for more
+                                 items before handling a batch
+        :param callable on_change: Called with the change in the number of
+                                   batches being handled
+        """
+        self.handler = handler
+        self.max_size = max_size
+        self.max_linger = max_linger
+        self.on_change = on_change
+
+        #: Number of batches handled.
+        self.batches = 0
+
+        # Items waiting for the next batch and their futures
+        self._items = []
+        self._futures = []
+        self._timer = None
+
+    async def __call__(self, item):
+        """ Returns the result of handling the item in a batch """
+        return await self.submit(item)
+
+    def submit(self, item):
+        """
+        Add the item to the next batch.
+
+        :return: Future for the result of the item
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        self._items.append(item)
+        self._futures.append(future)
+
+        if len(self._items) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_linger, self.flush)
+
+        return future
+
+    def flush(self):
+        """ Handle the items collected so far as a batch """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._items:
+            items, futures = self._items, self._futures
+            self._items, self._futures = [], []
+            self.batches += 1
+            asyncio.ensure_future(self._handle(items, futures))
+
+    async def _handle(self, items, futures):
+        if self.on_change:
+            self.on_change(1)
+
+        try:
+            results = await self.handler(items)
+            if len(results) != len(items):
+                raise ValueError('Handler returned {} results for {} items'
+                                 .format(len(results), len(items)))
+
+        except Exception as e:
+            for future in futures:
+                if not future.cancelled():
+                    future.set_exception(e)
+
+        else:
+            for future, result in zip(futures, results):
+                if not future.cancelled():
+                    future.set_result(result)
+
+        finally:
+            if self.on_change:
+                self.on_change(-1)
+
+
+class ShardedManager:
+    """
+    Runs jobs across processes, one per CPU by default, each with its own
+    event loop and AsyncManager, so coroutines are not limited to one CPU.
+
+    Jobs are sent to the processes in batches over sockets, either
+    round-robin or by the hash of a key so the same key always goes to the
+    same process, and results are sent back in batches as they finish. Both
+    sides read and write the sockets with the event loop, so neither blocks
+    on a full socket buffer while the other is waiting to write too.
+
+    .. code-block:: python
+
+        async def fetch(url):
+            ...
+
+        manager = ShardedManager(tasks=100)
+        async for result in manager.results(fetch, urls):
+            print(result)
+
+    The function needs to be defined at the top level of a module, and the
+    items and results need to be picklable.
+    """
+
+    def __init__(self, shards=None, tasks=100, batch_size=100):
+        """
+        :param int shards: Number of processes. Defaults to number of CPUs.
+        :param int tasks: Number of jobs to run at the same time in each
+                          process
+        :param int batch_size: Max number of jobs or results to send at once
+        """
+        #: Number of processes to run jobs in.
+        self.shards = shards or os.cpu_count() or 1
+
+        #: Number of jobs to run at the same time in each process.
+        self.tasks = tasks
+
+        #: Max number of jobs or results to send at once.
+        self.batch_size = batch_size
+
+    async def results(self, func, items, key=None):
+        """
+        Run the async function with each item in the processes and yield the
+        results as they finish.
+
+        :param func: Async function to call with each item
+        :param items: Iterable or async iterable of items
+        :param callable key: Returns the key of an item to pick its process
+                             by. Defaults to round-robin.
+        """
+        finished = asyncio.Queue()
+
+        writers = []
+        readers = []
+        processes = []
+        for _ in range(self.shards):
+            ours, theirs = socket.socketpair()
+            process = Process(target=_run_shard,
+                              args=(theirs, self.tasks, self.batch_size),
+                              daemon=True)
+            process.start()
+            theirs.close()
+
+            reader, writer = await asyncio.open_connection(sock=ours)
+            readers.append(asyncio.ensure_future(
+                _read_messages(reader, finished)))
+            writers.append(writer)
+            processes.append(process)
+
+        # Jobs to send to each process
+        batches = [[] for _ in range(self.shards)]
+
+        async def send(shard):
+            _write_message(writers[shard], batches[shard])
+            batches[shard] = []
+            await writers[shard].drain()
+
+        # Limit the jobs sent but not finished to keep memory bounded
+        window = self.shards * self.tasks * 2
+        sent = 0
+        received = 0
+
+        try:
+            async for item in _aiter(items):
+                shard = (hash(key(item)) if key else sent) % self.shards
+                batches[shard].append((sent, func, item))
+                sent += 1
+
+                if len(batches[shard]) >= self.batch_size:
+                    await send(shard)
+
+                while sent - received >= window:
+                    for shard, batch in enumerate(batches):
+                        if batch:
+                            await send(shard)
+
+                    for result in _unpack(await finished.get()):
+                        received += 1
+                        yield result
+
+            for shard, batch in enumerate(batches):
+                if batch:
+                    await send(shard)
+                _write_message(writers[shard], None)  # No more jobs
+
+            while received < sent:
+                for result in _unpack(await finished.get()):
+                    received += 1
+                    yield result
+
+        finally:
+            for reader in readers:
+                reader.cancel()
+            for writer in writers:
+                writer.close()
+
+            for process in processes:
+                if received < sent:
+                    process.terminate()
+                process.join()
+
+
+#: Length of a pickled message sent between processes
+_MESSAGE_LENGTH = struct.Struct('!Q')
+
+
+def _write_message(writer, message):
+    """ Write the message to the stream without waiting for it to be sent """
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.writelines([_MESSAGE_LENGTH.pack(len(data)), data])
+
+
+async def _read_messages(reader, messages):
+    """
+    Read messages from the stream into the queue until a None message. None
+    is queued if the other side is gone before that.
+    """
+    try:
+        while True:
+            length, = _MESSAGE_LENGTH.unpack(
+                await reader.readexactly(_MESSAGE_LENGTH.size))
+            message = pickle.loads(await reader.readexactly(length))
+            if message is None:
+                break
+            messages.put_nowait(message)
+
+    except (asyncio.IncompleteReadError, ConnectionError):
+        messages.put_nowait(None)
+
+
+def _unpack(batch):
+    """ Returns results from a batch of (id, error, result) """
+    if batch is None:
+        raise RuntimeError('Shard process exited before finishing its jobs')
+
+    for _, error, result in batch:
+        if error:
+            raise error
+        yield result
+
+
+def _run_shard(sock, tasks, batch_size):
+    """ Run jobs from the socket in a new event loop """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_serve_shard(sock, tasks, batch_size))
+    finally:
+        loop.close()
+
+
+async def _serve_shard(sock, tasks, batch_size):
+    """ Run jobs from the socket and send back their results """
+    loop = asyncio.get_event_loop()
+    manager = AsyncManager(tasks)
+    reader, writer = await asyncio.open_connection(sock=sock)
+    batches = asyncio.Queue()
+    reading = asyncio.ensure_future(_read_messages(reader, batches))
+    reading.add_done_callback(lambda _: batches.put_nowait(None))  # No more
+
+    results = []
+    running = 0
+    idle = asyncio.Event()
+
+    def send():
+        # The parent limits the jobs sent but not finished, so the results
+        # buffered while the socket is full stay bounded too.
+        if results:
+            _write_message(writer, results[:])
+            results.clear()
+
+    def done(job_id, future):
+        nonlocal running
+        running -= 1
+
+        error = future.exception()
+        results.append((job_id, error, None if error else future.result()))
+
+        # Results that finish in the same loop iteration are sent together
+        if len(results) >= batch_size:
+            send()
+        elif len(results) == 1:
+            loop.call_soon(send)
+
+        if not running:
+            idle.set()
+
+    try:
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+
+            idle.clear()
+            for job_id, func, item in batch:
+                future = manager.submit(partial(func, item))
+                future.add_done_callback(partial(done, job_id))
+                running += 1
+
+        if running:
+            await idle.wait()
+        send()
+        _write_message(writer, None)  # Done
+        await writer.drain()
+
+    finally:
+        reading.cancel()
+        manager.close()
+        writer.close()
+
+
+async def _aiter(jobs):
+    """ Iterate through the jobs whether it is an iterable or async one """
+    if hasattr(jobs, '__aiter__'):
+        async for job in jobs:
+            yield job
+    else:
+        for job in jobs:
+            yield job
+
+
+def _cancel_job(task, future):
+    """ Cancel the running job when its future from `submit` is cancelled """
+    if future.cancelled():
+        task.cancel()
+
+
+def _run_batch(jobs):
+    """
+    Run the jobs in a batch, returning (error, result) for each job so one
+    failure doesn't fail the rest.
+    """
+    results = []
+    for func, args, kwargs in jobs:
+        try:
+            results.append((None, func(*args, **kwargs)))
+        except Exception as e:
+            results.append((e, None))
+    return results
+
+
+def _set_results(futures, batch):
+    """ Set the result of each job in the batch on its future """
+    if batch.cancelled():
+        for future in futures:
+            future.cancel()
+        return
+
+    if batch.exception():
+        results = [(batch.exception(), None)] * len(futures)
+    else:
+        results = batch.result()
+
+    for future, (error, result) in zip(futures, results):
+        if future.cancelled():
+            continue
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+def benchmark(jobs=1000000):
+    """
+    Compare running many trivial jobs using a worker pool against creating
+    a coroutine for every job up front like `do_things_concurrently`, show
+    latency by priority when more jobs are submitted than can run, and
+    show how jobs/second scales with the number of shards.
+
+    :param int jobs: Number of jobs to run
+    """
+    loop = asyncio.get_event_loop()
+
+    async def job():
+        pass
+
+    async def create_all():
+        for future in asyncio.as_completed([job() for _ in range(jobs)]):
+            await future
+
+    # The worker pool goes first as max RSS only goes up
+    start_time = perf_counter()
+    loop.run_until_complete(AsyncManager(100).process(
+        job for _ in range(jobs)))
+    _show_benchmark('Worker pool', jobs, start_time)
+
+    start_time = perf_counter()
+    loop.run_until_complete(create_all())
+    _show_benchmark('Creating all at once', jobs, start_time)
+
+    loop.run_until_complete(_benchmark_priority())
+
+    for shards in range(1, (os.cpu_count() or 1) + 1):
+        loop.run_until_complete(_benchmark_shards(shards))
+
+    loop.run_until_complete(_benchmark_batches())
+
+
+async def _benchmark_batches(jobs=100000, batch_sizes=(1, 10, 100, 1000)):
+    """
+    Compare running a task per job against batching jobs of different sizes
+    for a handler with a fixed cost per call.
+
+    :param int jobs: Number of jobs to run
+    :param tuple batch_sizes: Max batch sizes to try
+    """
+    async def handle(numbers):
+        await asyncio.sleep(0)  # Fixed cost, such as a round trip
+        return [n * 2 for n in numbers]
+
+    start_time = perf_counter()
+    await asyncio.gather(*[handle([n]) for n in range(jobs)])
+    duration = perf_counter() - start_time
+    print('Task per job: {:.0f} jobs/second'.format(jobs / duration))
+
+    for batch_size in batch_sizes:
+        batcher = Batcher(handle, max_size=batch_size)
+
+        start_time = perf_counter()
+        await asyncio.gather(*[batcher.submit(n) for n in range(jobs)])
+        duration = perf_counter() - start_time
+        print('Batches of {}: {:.0f} jobs/second'.format(batch_size,
+                                                         jobs / duration))
+
+
+async def _benchmark_shards(shards, jobs=20000, steps=50):
+    """
+    Show the jobs/second when running coroutine heavy jobs with the given
+    number of shards.
+
+    :param int shards: Number of processes to run jobs in
+    :param int jobs: Number of jobs to run
+    :param int steps: Number of times each job yields to the event loop
+    """
+    manager = ShardedManager(shards)
+
+    start_time = perf_counter()
+    async for _ in manager.results(_yield_often, [steps] * jobs):
+        pass
+    duration = perf_counter() - start_time
+
+    print('{} shards: {:.0f} jobs/second'.format(shards, jobs / duration))
+
+
+async def _yield_often(steps):
+    """ Job for benchmarking that yields to the event loop many times """
+    for _ in range(steps):
+        await asyncio.sleep(0)
+    return steps
+
+
+async def _benchmark_priority(duration=3, rate=1500, workers=10,
+                              job_duration=0.01, urgent_ratio=0.1):
+    """
+    Submit jobs at a higher rate than the workers can handle and show the
+    latency from submit to finish for each priority.
+
+    :param float duration: Number of seconds to submit jobs for
+    :param int rate: Number of jobs to submit per second
+    :param int workers: Number of jobs to run at the same time
+    :param float job_duration: Number of seconds each job takes
+    :param float urgent_ratio: Portion of jobs with high priority
+    """
+    loop = asyncio.get_event_loop()
+    manager = AsyncManager(workers, aging=5)
+    latencies = defaultdict(list)
+    rand = random.Random(0)
+
+    async def job():
+        await asyncio.sleep(job_duration)
+
+    def finished(priority, submitted, future):
+        if not future.exception():
+            latencies[priority].append(loop.time() - submitted)
+
+    futures = []
+    interval = 0.01
+    start_time = loop.time()
+    while loop.time() - start_time < duration:
+        for _ in range(int(rate * interval)):
+            if rand.random() < urgent_ratio:
+                future = manager.submit(job, priority=0, deadline=0.5)
+                future.add_done_callback(partial(finished, 0, loop.time()))
+            else:
+                future = manager.submit(job, priority=1)
+                future.add_done_callback(partial(finished, 1, loop.time()))
+            futures.append(future)
+        await asyncio.sleep(interval)
+
+    await asyncio.wait(futures)
+    manager.close()
+
+    print('Submitted {} jobs/second for {} workers that can run {:.0f} '
+          'jobs/second:'.format(rate, workers, workers / job_duration))
+    for priority in sorted(latencies):
+        values = sorted(latencies[priority])
+        print('  Priority {}: {} jobs, p50 {:.0f} ms, p99 {:.0f} ms'.format(
+            priority, len(values), values[len(values) // 2] * 1000,
+            values[int(len(values) * 0.99)] * 1000))
+    print('  Dropped {} jobs that missed their deadline'.format(
+        manager.expired_jobs))
+
+
+def _show_benchmark(title, jobs, start_time):
+    duration = perf_counter() - start_time
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    print('{} ran {} jobs in {:.2f} seconds (max RSS {} MB)'.format(
+        title, jobs, duration, max_rss))
 
 
 if __name__ == "__main__":
-    main()
+    if '--benchmark' in sys.argv:
+        benchmark()
+    else:
+        main()
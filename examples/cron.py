@@ -2,7 +2,13 @@
 Cron Clone: Run commands at set times
 =============================================================================
 
-Like cron that runs arbitrary shell commands in scheduled time.
+Like cron that runs arbitrary shell commands in scheduled time. Entries are
+either a time of day, such as '6:00 AM', or a standard cron expression with
+five fields (minute hour day month weekday) or six fields (second first).
+
+Instead of waking up every minute to check if anything needs to run, the
+scheduler keeps a min-heap of when each entry is due next and sleeps until
+the earliest one. After an entry fires, it is re-armed for its next time.
 
 Example Run
 -----------------------------------------------------------------------------
@@ -10,27 +16,68 @@ $ python3 examples/cron.py
 
 Press CTRL+C to exit
 11:57 AM
-  Running echo Commands are run concurrently
   Running echo Cron started at this time
-Commands are run concurrently
+  Running echo Commands are run concurrently
 Cron started at this time
+Commands are run concurrently
 ^C
 
+$ echo '{"*/10 * * * * *": ["date"]}' > schedule.json
+$ python3 examples/cron.py schedule.json
+Press CTRL+C to exit
+*/10 * * * * *
+  Running date
+Sat Oct 17 11:57:30 PDT 2026
+^C
+
+$ python3 examples/cron.py --benchmark
+Compiled 50000 expressions in 1.53 seconds
+Computed 50000 next runs in 0.31 seconds (6.1 us each)
+shell mode: 2.18 ms to run a process
+shell mode: 427 jobs/second with 1 running at a time
+exec mode: 1.40 ms to run a process
+exec mode: 688 jobs/second with 1 running at a time
+
 References
 -----------------------------------------------------------------------------
 https://docs.python.org/3/library/asyncio-subprocess.html
 https://docs.python.org/2/library/datetime.html#strftime-strptime-behavior
-
+https://docs.python.org/3/library/heapq.html
+https://man7.org/linux/man-pages/man5/crontab.5.html
 """
 
 import asyncio
-from datetime import datetime
+from bisect import bisect_left
+import calendar
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from hashlib import sha1
+from heapq import heapify, heappop, heappush
+from itertools import count
+import json
+import mmap
+import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import struct
+import sys
+from time import perf_counter, time
 
 
-def main():
-    schedule = {
+def main(schedule_file=None):
+    """
+    :param str schedule_file: Path to a JSON schedule file to run instead
+                              of the example schedule
+    """
+    schedule = schedule_file or {
         '6:00 AM': ['ls -l', 'pwd'],
         '7:00 PM': ['ps'],
+        '0 9 * * mon-fri': ['echo Good morning'],
         _current_time(): ['echo Cron started at this time',
                           'echo Commands are run concurrently'],
     }
@@ -44,29 +91,1409 @@ def main():
         pass
 
 
-async def cron(schedule):
+async def cron(schedule, scheduler=None, pool=None, metrics=None):
     """
     Run the commands based on the given schedule
 
-    :param dict schedule: Map of time to list of commands to run.
+    :param dict|str schedule: Map of time to list of commands to run, or
+                              path to a JSON file with the map, which is
+                              reloaded when it changes.
+    :param Scheduler scheduler: Scheduler to use. Defaults to a new one.
+    :param ProcessPool pool: Pool to run the commands in. Defaults to a new
+                             one.
+    :param Metrics metrics: Metrics to record how late entries fire and how
+                            long commands run.
     """
     print('Press CTRL+C to exit')
 
-    while True:
-        current_time = _current_time()
+    schedule_file = None
+    if isinstance(schedule, str):
+        schedule_file = ScheduleFile(schedule)
+        schedule = schedule_file.load()
+
+    if scheduler is None:
+        scheduler = Scheduler()
+    scheduler.add_schedule(schedule)
+
+    if pool is None:
+        pool = ProcessPool()
+    pool.prepare(schedule)
+
+    dumping = None
+    if metrics:
+        scheduler.metrics = pool.metrics = metrics
+        metrics.gauge('cron_scheduled_entries', 'Number of schedule entries',
+                      scheduler.__len__)
+        metrics.gauge('cron_queued_commands', 'Number of commands waiting '
+                      'to run', lambda: pool.queued)
+        metrics.gauge('cron_running_commands', 'Number of commands running',
+                      lambda: pool.running)
+        if metrics.path:
+            dumping = asyncio.ensure_future(metrics.dump_periodically())
+
+    max_sleep = Scheduler.MAX_SLEEP
+    if schedule_file:
+        max_sleep = min(max_sleep, ScheduleFile.CHECK_INTERVAL)
+
+    try:
+        while True:
+            if schedule_file and schedule_file.changed():
+                _reload(scheduler, pool, schedule_file)
+
+            due = scheduler.next_due()
+            if due is None and not schedule_file:
+                return
+
+            # Sleep until the earliest entry is due, but wake up at least
+            # every so often so a changed wall clock or schedule file is
+            # noticed.
+            delay = max_sleep if due is None else due - time()
+            if delay > 0:
+                await asyncio.sleep(min(delay, max_sleep))
+                continue
+
+            for when, due, commands in scheduler.pop_due():
+                print(when)
+
+                # Don't wait for the commands to finish, otherwise a slow
+                # batch would push back everything scheduled after it.
+                for cmd in commands:
+                    future = pool.submit(cmd, due=due)
+                    if scheduler.journal:
+                        future.add_done_callback(
+                            partial(_record_complete, scheduler.journal,
+                                    when, due))
+
+    finally:
+        await pool.close()
+
+        if dumping:
+            dumping.cancel()
+            await asyncio.wait([dumping])
+
+
+def _reload(scheduler, pool, schedule_file):
+    """ Update the scheduler with changes from the schedule file """
+    try:
+        # Loading validates the whole schedule before anything is changed
+        schedule = schedule_file.load()
+        pool.prepare(schedule)
+        added, removed, changed = scheduler.update(schedule)
+
+    except (OSError, ValueError) as e:
+        print('Keeping current schedule as', schedule_file.path,
+              'could not be loaded:', e)
+
+    else:
+        print('Reloaded {}: {} added, {} removed, {} changed'.format(
+            schedule_file.path, added, removed, changed))
+
+
+class Scheduler:
+    """
+    Min-heap of next-due timestamps for schedule entries.
+
+    Each fire pops the earliest entry and pushes it back with its next time,
+    so it costs O(log n) regardless of how many entries there are. Removed
+    entries are only marked as removed and skipped when they reach the top,
+    so updating the schedule costs O(log n) per changed entry as well.
+
+    With a journal, fires are recorded so runs missed while cron was not
+    running can be caught up on next start based on the catch up policy:
+
+        * skip: Don't run missed fires
+        * once: Run once if any fire was missed
+        * all: Run once for every missed fire
+
+    .. code-block:: python
+
+        scheduler = Scheduler()
+        scheduler.add('6:00 AM', ['ls -l'])
+        scheduler.next_due()   # Timestamp of the next 6:00 AM
+    """
+
+    #: Max number of seconds to sleep before checking the wall clock again
+    MAX_SLEEP = 60
+
+    CATCH_UP_POLICIES = ('skip', 'once', 'all')
+
+    # Index of fields in a heap entry: [due, sequence, when, trigger,
+    # commands]. Commands is None when the entry is removed.
+    _DUE, _WHEN, _TRIGGER, _COMMANDS = 0, 2, 3, 4
+
+    def __init__(self, journal=None, catch_up='skip'):
+        """
+        :param Journal journal: Journal to record fires to
+        :param str catch_up: Policy to catch up on fires missed since the
+                             last fire in the journal: skip, once, or all
+        """
+        if catch_up not in self.CATCH_UP_POLICIES:
+            raise ValueError('Catch up policy should be one of {}: {!r}'
+                             .format(self.CATCH_UP_POLICIES, catch_up))
+
+        #: Journal to record fires to
+        self.journal = journal
+
+        #: Policy to catch up on missed fires
+        self.catch_up = catch_up
+
+        #: Heap of entries ordered by when they are due
+        self._heap = []
+
+        # Map of when to its entry in the heap
+        self._entries = {}
+
+        # Number of removed entries still in the heap
+        self._removed = 0
+
+        # Tie breaker so entries due at the same time fire in the order
+        # they were added, and triggers are never compared.
+        self._sequence = count()
+
+        #: Number of entries fired.
+        self.fires = 0
+
+        #: Total / max seconds that entries fired after they were due.
+        self.total_lag = 0
+        self.max_lag = 0
+
+        #: Metrics to record fire lag to
+        self.metrics = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, when):
+        return when in self._entries
+
+    def add_schedule(self, schedule, now=None):
+        """
+        Add all entries in the given schedule, looking up when they last
+        fired in the journal.
+
+        :param dict schedule: Map of time to list of commands to run.
+        :param float now: Current timestamp. Defaults to time()
+        """
+        last_fires = {}
+        if self.journal:
+            last_fires = self.journal.last_fires(schedule)
+
+        for when, commands in schedule.items():
+            self.add(when, commands, now=now, last_fire=last_fires.get(when))
+
+    def update(self, schedule, now=None):
+        """
+        Update to the given schedule by only adding, removing, or changing
+        the entries that are different.
+
+        :param dict schedule: Map of time to list of commands to run.
+        :param float now: Current timestamp. Defaults to time()
+        :return: Tuple of number of entries added, removed, and changed
+        """
+        removed = [when for when in self._entries if when not in schedule]
+        for when in removed:
+            self.remove(when)
+
+        added = {}
+        changed = 0
+        for when, commands in schedule.items():
+            entry = self._entries.get(when)
+            if entry is None:
+                added[when] = commands
+
+            elif entry[self._COMMANDS] != commands:
+                # Still due at the same time, so just swap the commands.
+                entry[self._COMMANDS] = commands
+                changed += 1
+
+        self.add_schedule(added, now=now)
+
+        return len(added), len(removed), changed
+
+    def add(self, when, commands, now=None, last_fire=None):
+        """
+        Add an entry to the schedule, replacing any existing one.
+
+        An entry that is due in the current period (e.g. '11:57 AM' when it
+        is 11:57:30 AM) fires right away unless it already fired.
+
+        :param str when: When to run the commands, such as '6:00 AM' or a
+                         cron expression like '*/5 * * * *'
+        :param list commands: Commands to run
+        :param float now: Current timestamp. Defaults to time()
+        :param float last_fire: When the entry was last due and fired, which
+                                is used to catch up on missed fires.
+        """
+        if now is None:
+            now = time()
+
+        trigger = parse_trigger(when)
+        start = int(now) - int(now) % trigger.resolution
+        due = trigger.next_after(start - 1)
+
+        if last_fire is not None:
+            missed = trigger.next_after(last_fire)
+            due = max(due, missed) if self.catch_up == 'skip' else missed
+
+        if when in self._entries:
+            self.remove(when)
+
+        self._push(due, when, trigger, commands)
+
+    def remove(self, when):
+        """
+        Remove the entry from the schedule.
+
+        :param str when: When the entry runs, i.e. its schedule key
+        """
+        self._entries.pop(when)[self._COMMANDS] = None
+        self._removed += 1
+
+        # Rebuild the heap once it is mostly removed entries
+        if self._removed > len(self._entries):
+            self._heap = [e for e in self._heap
+                          if e[self._COMMANDS] is not None]
+            heapify(self._heap)
+            self._removed = 0
+
+    def _push(self, due, when, trigger, commands):
+        entry = [due, next(self._sequence), when, trigger, commands]
+        self._entries[when] = entry
+        heappush(self._heap, entry)
+
+    def _pop(self):
+        """ Pop the earliest entry, skipping removed ones """
+        entry = heappop(self._heap)
+        if entry[self._COMMANDS] is None:
+            self._removed -= 1
+            return None
+        del self._entries[entry[self._WHEN]]
+        return entry
+
+    def next_due(self):
+        """ Returns timestamp of the earliest entry, or None if empty. """
+        while self._heap and self._heap[0][self._COMMANDS] is None:
+            self._pop()
+        return self._heap[0][self._DUE] if self._heap else None
+
+    def pop_due(self, now=None):
+        """
+        Yield (when, due, commands) for entries that are due and re-arm them
+        for their next time.
+
+        :param float now: Current timestamp. Defaults to time()
+        """
+        if now is None:
+            now = time()
+
+        while self._heap and self._heap[0][self._DUE] <= now:
+            entry = self._pop()
+            if entry is None:
+                continue
+            due, _, when, trigger, commands = entry
+
+            lag = now - due
+            self.fires += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if self.metrics:
+                self.metrics.fire_lag.observe(lag)
+
+            if self.journal:
+                self.journal.record_fire(when, due, now)
+
+            # Re-arm from now instead of the due time so a late entry
+            # fires once instead of once per missed period, unless all
+            # missed fires should run.
+            start = due if self.catch_up == 'all' else now
+            next_due = trigger.next_after(start)
+
+            # A trigger that doesn't move forward would be due again right
+            # away and keep this loop from ever ending.
+            if next_due <= start:
+                next_due = now + trigger.resolution
+            self._push(next_due, when, trigger, commands)
+
+            yield when, due, commands
+
+    @property
+    def average_lag(self):
+        """ Average seconds that entries fired after they were due """
+        return self.total_lag / self.fires if self.fires else 0
+
+
+class ScheduleFile:
+    """
+    JSON file with a map of time to list of commands to run, such as
+    {"6:00 AM": ["ls -l", "pwd"], "*/5 * * * *": ["date"]}.
+
+    Changes are detected by comparing the inode, modification time, and
+    size of the file, so checking is a single stat call.
+    """
+
+    #: Number of seconds between checks for changes
+    CHECK_INTERVAL = 1
+
+    def __init__(self, path):
+        """
+        :param str path: Path to the schedule file
+        """
+        self.path = path
+        self._signature = None
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def changed(self):
+        """ Returns True if the file changed since it was last loaded """
+        try:
+            return self._stat() != self._signature
+        except OSError:
+            return False  # Keep the current schedule while it is missing
+
+    def load(self):
+        """ Returns the schedule from the file """
+        # Stat before reading so a change while reading is seen next time
+        signature = self._stat()
+
+        with open(self.path) as fp:
+            schedule = json.load(fp)
+
+        def is_commands(commands):
+            return isinstance(commands, list) and all(
+                isinstance(cmd, str) for cmd in commands)
+
+        if not isinstance(schedule, dict) or not all(
+                is_commands(c) for c in schedule.values()):
+            raise ValueError('Schedule should be a map of time to list of '
+                             'commands')
+
+        # Parse every time up front so a bad one fails the whole load
+        # instead of part of the update.
+        for when in schedule:
+            parse_trigger(when)
+
+        self._signature = signature
+        return schedule
+
+
+class Journal:
+    """
+    Append-only journal of when schedule entries fired and completed.
+
+    Each event is a fixed-size binary record, so the journal can be memory
+    mapped and scanned backwards from the end on start up to find when each
+    entry last fired without parsing its whole history.
+
+    When each entry last fired is also kept in memory, and written to the
+    journal as a checkpoint every `checkpoint_interval` fires, so the scan
+    stops at the last checkpoint even for entries that never fired.
+
+    .. code-block:: python
+
+        journal = Journal('cron.journal')
+        scheduler = Scheduler(journal=journal, catch_up='once')
+    """
+
+    FIRE = 1
+    COMPLETE = 2
+
+    #: When an entry last fired, as of the checkpoint
+    CHECKPOINT = 3
+
+    #: End of a checkpoint, with the number of its records as the key
+    CHECKPOINT_END = 4
+
+    #: Entry key, due time, event time, exit status, and event type
+    _RECORD = struct.Struct('<QddiB3x')
+
+    # Exit status for fire events and commands that could not be started
+    _NO_STATUS = -2 ** 31
+
+    def __init__(self, path, checkpoint_interval=10000):
+        """
+        :param str path: Path to the journal file. Created if missing.
+        :param int checkpoint_interval: Number of fires between checkpoints
+        """
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+
+        # Map of entry key to when it was last due
+        self._last_fires, scanned = self._load_last_fires()
+
+        # Unbuffered so every event is written out as it happens
+        self._fp = open(path, 'ab', buffering=0)
+
+        # Drop a partial record from a crash so new ones stay aligned
+        size = self._fp.tell()
+        if size % self._RECORD.size:
+            self._fp.truncate(size - size % self._RECORD.size)
+
+        self._fires_since_checkpoint = scanned
+        if scanned >= checkpoint_interval:
+            self._checkpoint()
+
+    def close(self):
+        self._fp.close()
+
+    def record_fire(self, when, due, now=None):
+        """
+        Record that the entry fired.
+
+        :param str when: When the entry runs, i.e. its schedule key
+        :param float due: When the entry was due
+        :param float now: Current timestamp. Defaults to time()
+        """
+        self._record(self.FIRE, when, due, now, None)
+        self._last_fires[_journal_key(when)] = due
+
+        self._fires_since_checkpoint += 1
+        if self._fires_since_checkpoint >= self.checkpoint_interval:
+            self._checkpoint()
+
+    def record_complete(self, when, due, status, now=None):
+        """
+        Record that a command of the entry completed.
+
+        :param str when: When the entry runs, i.e. its schedule key
+        :param float due: When the entry was due
+        :param int status: Exit status of the command
+        :param float now: Current timestamp. Defaults to time()
+        """
+        self._record(self.COMPLETE, when, due, now, status)
+
+    def _record(self, event, when, due, now, status):
+        self._fp.write(self._RECORD.pack(
+            _journal_key(when), due, time() if now is None else now,
+            self._NO_STATUS if status is None else status, event))
+
+    def _checkpoint(self):
+        """ Write when each entry last fired, ending with the count """
+        now = time()
+        pack = self._RECORD.pack
+        records = [pack(key, due, now, self._NO_STATUS, self.CHECKPOINT)
+                   for key, due in self._last_fires.items()]
+        records.append(pack(len(records), 0, now, self._NO_STATUS,
+                            self.CHECKPOINT_END))
+        self._fp.write(b''.join(records))
+        self._fires_since_checkpoint = 0
+
+    def events(self):
+        """ Yield (key, due, time, status, event) for all records """
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+        size = len(data) - len(data) % self._RECORD.size
+        yield from self._RECORD.iter_unpack(data[:size])
+
+    def last_fires(self, whens):
+        """
+        Returns a map of when each of the given entries was last due and
+        fired, for entries that have fired.
+
+        :param list whens: Schedule keys of the entries to look up
+        """
+        last_fires = {}
+        for when in whens:
+            due = self._last_fires.get(_journal_key(when))
+            if due is not None:
+                last_fires[when] = due
+        return last_fires
+
+    def _load_last_fires(self):
+        """
+        Returns a map of entry key to when it last fired, and the number of
+        records scanned, by scanning backwards to the last checkpoint.
+        """
+        last_fires = {}
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return last_fires, 0
+
+        record_size = self._RECORD.size
+        size -= size % record_size  # Ignore partial write from a crash
+        if not size:
+            return last_fires, 0
+
+        with open(self.path, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            unpack_from = self._RECORD.unpack_from
+
+            # Most recent events are at the end, so stop at the checkpoint
+            # as it has the last fires of everything before it. A checkpoint
+            # without its end, from a crash while writing it, is skipped.
+            scanned = 0
+            for offset in range(size - record_size, -1, -record_size):
+                key, due, _, _, event = unpack_from(data, offset)
+                scanned += 1
+
+                if event == self.FIRE:
+                    last_fires.setdefault(key, due)
+
+                elif event == self.CHECKPOINT_END:
+                    start = offset - key * record_size
+                    for checkpoint in range(start, offset, record_size):
+                        key, due, _, _, _ = unpack_from(data, checkpoint)
+                        last_fires.setdefault(key, due)
+                    break
+
+        return last_fires, scanned
+
+
+def _journal_key(when):
+    """ Returns a 64-bit key for the schedule entry """
+    return int.from_bytes(sha1(when.encode()).digest()[:8], 'little')
+
+
+def _record_complete(journal, when, due, future):
+    """ Record the exit status of a command in the journal """
+    if not future.cancelled():
+        # Commands that failed to run are recorded without a status
+        status = None if future.exception() else future.result()
+        journal.record_complete(when, due, status)
+
+
+class DailyTime:
+    """ Trigger that fires at the same time every day """
+
+    _FORMATS = {'%I:%M %p': 60, '%I:%M:%S %p': 1}
+
+    def __init__(self, when):
+        """
+        :param str when: Time of day in 'H:MM AM/PM' or 'H:MM:SS AM/PM'
+        """
+        for fmt, resolution in self._FORMATS.items():
+            try:
+                parsed = datetime.strptime(when, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError('Invalid time: ' + repr(when))
+
+        #: Hour, minute, and second of the day to fire.
+        self.time = parsed.time()
+
+        #: Number of seconds the time spans, i.e. 60 when seconds are not
+        #: given.
+        self.resolution = resolution
+
+    def next_after(self, timestamp):
+        """ Returns the first timestamp after the given one to fire at. """
+        moment = datetime.fromtimestamp(timestamp)
+        fire_at = datetime.combine(moment.date(), self.time)
+
+        if fire_at.timestamp() <= timestamp:
+            fire_at += timedelta(days=1)
+
+        return fire_at.timestamp()
+
+
+class CronExpression:
+    """
+    Trigger for a cron expression, such as '*/5 9-17 * * mon-fri'.
+
+    Each field is compiled once into a bitset of allowed values, so finding
+    the next run is a few bit operations per field instead of scanning
+    minute by minute.
+    """
+
+    #: Name, min, and max value of each field
+    _FIELDS = (('second', 0, 59), ('minute', 0, 59), ('hour', 0, 23),
+               ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+
+    _NAMES = {
+        'month': {name.lower(): i
+                  for i, name in enumerate(calendar.month_abbr) if name},
+        'weekday': {'sun': 0, 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4,
+                    'fri': 5, 'sat': 6},
+    }
+
+    _ALIASES = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+    }
+
+    # Number of years to look ahead before giving up, which covers a leap
+    # day that skips a century year (e.g. Feb 29 after 2096 is in 2104).
+    _MAX_YEARS = 9
+
+    def __init__(self, expression):
+        """
+        :param str expression: Cron expression with 5 or 6 fields
+        """
+        #: The original expression
+        self.expression = expression
+
+        fields = self._ALIASES.get(expression, expression).split()
+        if len(fields) == 5:
+            fields.insert(0, '0')
+            self.resolution = 60
+        elif len(fields) == 6:
+            self.resolution = 1
+        else:
+            raise ValueError('Cron expression should have 5 or 6 '
+                             'fields: ' + repr(expression))
+
+        (self._seconds, self._minutes, self._hours, days, self._months,
+         weekdays) = [self._parse_field(field, *spec)
+                      for field, spec in zip(fields, self._FIELDS)]
+
+        # Sunday can be 0 or 7
+        if weekdays & 1 << 7:
+            weekdays = (weekdays | 1) & ~(1 << 7)
+
+        # Like cron, when both day and weekday are restricted, a day that
+        # matches either one runs.
+        self._days = days
+        self._weekdays = weekdays
+        self._any_day = fields[3].startswith('*')
+        self._any_weekday = fields[5].startswith('*')
+
+        # Days of the month that match the weekdays, indexed by the weekday
+        # of the first day of the month.
+        self._weekday_days = _weekday_days(weekdays)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.expression)
+
+    @classmethod
+    def _parse_field(cls, field, name, low, high):
+        """ Returns a bitset of the values allowed by the given field """
+        names = cls._NAMES.get(name, {})
+        bits = 0
+
+        for part in field.split(','):
+            value_range, _, step = part.partition('/')
+            step = int(step) if step else 1
+
+            if value_range == '*':
+                start, end = low, high
+            else:
+                start, _, end = value_range.partition('-')
+                start = int(names.get(start.lower(), start))
+                if end:
+                    end = int(names.get(end.lower(), end))
+                else:
+                    end = high if step > 1 else start
+
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('Invalid {} field: {!r}'.format(name,
+                                                                 field))
+
+            for value in range(start, end + 1, step):
+                bits |= 1 << value
+
+        return bits
+
+    def _days_in(self, year, month):
+        """ Returns a bitset of days to run in the given month """
+        first_weekday, days = calendar.monthrange(year, month)
+        weekday_days = self._weekday_days[(first_weekday + 1) % 7]
+
+        if self._any_weekday:
+            mask = self._days
+        elif self._any_day:
+            mask = weekday_days
+        else:
+            mask = self._days | weekday_days
+
+        return mask & ((1 << days + 1) - 2)
+
+    def next_after(self, timestamp):
+        """ Returns the first timestamp after the given one to fire at. """
+        moment = datetime.fromtimestamp(int(timestamp) + 1)
+        year, month, day = moment.year, moment.month, moment.day
+        hour, minute, second = moment.hour, moment.minute, moment.second
+
+        while year <= moment.year + self._MAX_YEARS:
+            next_month = _next_bit(self._months, month)
+            if next_month is None:
+                year, month, day = year + 1, 1, 1
+                hour, minute, second = 0, 0, 0
+                continue
+            if next_month != month:
+                month, day, hour, minute, second = next_month, 1, 0, 0, 0
+
+            next_day = _next_bit(self._days_in(year, month), day)
+            if next_day is None:
+                year, month = (year + 1, 1) if month == 12 else (year,
+                                                                 month + 1)
+                day, hour, minute, second = 1, 0, 0, 0
+                continue
+            if next_day != day:
+                day, hour, minute, second = next_day, 0, 0, 0
+
+            next_hour = _next_bit(self._hours, hour)
+            if next_hour is None:
+                day, hour, minute, second = day + 1, 0, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute, second = next_hour, 0, 0
+
+            next_minute = _next_bit(self._minutes, minute)
+            if next_minute is None:
+                hour, minute, second = hour + 1, 0, 0
+                continue
+            if next_minute != minute:
+                minute, second = next_minute, 0
+
+            next_second = _next_bit(self._seconds, second)
+            if next_second is None:
+                minute, second = minute + 1, 0
+                continue
+
+            fire_at = datetime(year, month, day, hour, minute, next_second)
+
+            # When clocks go back for DST, the time is repeated and the
+            # first one may have passed already.
+            if fire_at.timestamp() <= timestamp:
+                fire_at = fire_at.replace(fold=1)
+
+            return fire_at.timestamp()
+
+        raise ValueError('No time matches ' + repr(self.expression))
+
+
+@lru_cache(maxsize=128)
+def _weekday_days(weekdays):
+    """
+    Returns a bitset of days of the month that fall on the given weekdays
+    for each weekday the month could start on.
+
+    :param int weekdays: Bitset of weekdays where Sunday is 0
+    """
+    masks = []
+    for first_weekday in range(7):
+        week = 0
+        for offset in range(7):
+            if weekdays & 1 << (first_weekday + offset) % 7:
+                week |= 1 << offset
+        masks.append(sum(week << 1 + 7 * i for i in range(5)))
+    return tuple(masks)
+
+
+def _next_bit(bits, value):
+    """ Returns the lowest set bit in bits at or above value, or None. """
+    bits >>= value
+    if not bits:
+        return None
+    return value + (bits & -bits).bit_length() - 1
+
+
+@lru_cache(maxsize=65536)
+def parse_trigger(when):
+    """
+    Returns the trigger for the given schedule time. Triggers don't change
+    once created, so the same one is shared by entries with the same time.
+
+    :param str when: Time of day, such as '6:00 AM', or a cron expression
+    """
+    if when.upper().endswith(('AM', 'PM')):
+        return DailyTime(when)
+    return CronExpression(when)
+
+
+class ProcessPool:
+    """
+    Runs shell commands with a limit on how many run at the same time.
+
+    Commands that can't run right away wait in a priority queue (FIFO for
+    the same priority). Each command runs in its own process group, which is
+    killed if the command times out, and every process is waited on so no
+    zombies are left behind.
+
+    When a log dir is given, the output of each command is read from a pipe
+    in chunks and written to its own log file in the dir, which rotates
+    when it gets too big. Otherwise, commands write to our stdout.
+
+    Without use_shell, commands that don't need shell features like pipes
+    or variables are run directly instead of through /bin/sh, which saves
+    starting a shell for every command. The command is split into args
+    once and reused for every run. There is no need for a pre-forked
+    helper to spawn from as CPython starts processes using vfork (or
+    posix_spawn), so the cost does not grow with the size of our process.
+
+    .. code-block:: python
+
+        pool = ProcessPool(max_running=4, timeout=60)
+        status = await pool.submit('ls -l')   # Exit status: 0
+        await pool.close()
+    """
+
+    #: Number of bytes to read from a command's output at a time
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, max_running=None, timeout=None, log_dir=None,
+                 max_log_bytes=10 * 1024 * 1024, log_backups=3,
+                 use_shell=True):
+        """
+        :param int max_running: Max number of commands to run at the same
+                                time. Defaults to the number of CPUs.
+        :param float timeout: Default number of seconds a command can run
+                              before it is killed. Defaults to no limit.
+        :param str log_dir: Dir to write the output of each command to
+        :param int max_log_bytes: Max size of a log file before it rotates
+        :param int log_backups: Number of rotated log files to keep
+        :param bool use_shell: Run all commands through /bin/sh
+        """
+        #: Max number of commands to run at the same time
+        self.max_running = max_running or os.cpu_count() or 1
+
+        #: Default number of seconds a command can run
+        self.timeout = timeout
+
+        #: Number of commands currently running
+        self.running = 0
+
+        #: Number of finished commands by exit status. Killed commands have
+        #: a negative status of the signal number, and None is for commands
+        #: that could not be started.
+        self.exit_statuses = Counter()
+
+        #: Dir to write the output of each command to
+        self.log_dir = log_dir
+        self.max_log_bytes = max_log_bytes
+        self.log_backups = log_backups
+
+        # Log for each command, shared by its runs so they rotate together.
+        self._logs = {}
+
+        #: Run all commands through /bin/sh
+        self.use_shell = use_shell
+
+        #: Metrics to record start lag and run time to
+        self.metrics = None
+
+        # Created when the first command is submitted, so the pool can be
+        # created outside of the event loop.
+        self._queue = None
+        self._workers = []
+        self._sequence = count()
+
+    @property
+    def queued(self):
+        """ Number of commands waiting to run """
+        return self._queue.qsize() if self._queue else 0
+
+    def submit(self, cmd, priority=0, timeout=None, due=None):
+        """
+        Queue the given shell command to run.
+
+        :param str cmd: Shell command to run
+        :param int priority: Commands with lower priority run first
+        :param float timeout: Number of seconds the command can run before
+                              it is killed. Defaults to the pool's timeout.
+        :param float due: When the command should have started, used to
+                          measure start lag. Defaults to now.
+        :return: Future for the exit status of the command
+        """
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._workers = [asyncio.ensure_future(self._work())
+                             for _ in range(self.max_running)]
+
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((priority, next(self._sequence), cmd,
+                                timeout or self.timeout,
+                                time() if due is None else due, future))
+        return future
+
+    def prepare(self, schedule):
+        """
+        Split the commands in the schedule into args ahead of time, so it
+        is not done when they run.
+
+        :param dict schedule: Map of time to list of commands to run.
+        """
+        if not self.use_shell:
+            for commands in schedule.values():
+                for cmd in commands:
+                    command_args(cmd)
+
+    async def join(self):
+        """ Wait for all submitted commands to finish """
+        if self._queue:
+            await self._queue.join()
+
+    async def close(self):
+        """ Kill running commands and cancel the ones that are queued """
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.wait(self._workers)
+
+        while self.queued:
+            self._queue.get_nowait()[-1].cancel()
+        self._workers = []
+        self._queue = None
+
+    async def _work(self):
+        """ Run queued commands one at a time """
+        while True:
+            _, _, cmd, timeout, due, future = await self._queue.get()
+
+            try:
+                if not future.cancelled():
+                    if self.metrics:
+                        self.metrics.start_lag.observe(time() - due)
+                    status = await self._run(cmd, timeout)
+
+                    # The caller may have cancelled it while it ran
+                    if not future.done():
+                        future.set_result(status)
+
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+
+            except Exception as e:
+                # Keep the worker going for the rest of the queue
+                print('  Failed to run', cmd, e)
+                if not future.done():
+                    future.set_exception(e)
+
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, cmd, timeout):
+        """ Run the given shell command and return its exit status """
+        print('  Running', cmd)
+
+        if self.log_dir:
+            pipes = dict(stdout=asyncio.subprocess.PIPE,
+                         stderr=asyncio.subprocess.STDOUT)
+        else:
+            pipes = {}
+
+        args = None if self.use_shell else command_args(cmd)
+
+        start_time = perf_counter()
+        self.running += 1
+        try:
+            if args:
+                process = await asyncio.create_subprocess_exec(
+                    *args, start_new_session=True, **pipes)
+            else:
+                process = await asyncio.create_subprocess_shell(
+                    cmd, start_new_session=True, **pipes)
+
+        except OSError as e:
+            print('  Failed to run', cmd, e)
+            status = None
+
+        else:
+            if self.log_dir:
+                saving = asyncio.ensure_future(
+                    self._save_output(process.stdout, self._log_for(cmd)))
+
+            try:
+                status = await asyncio.wait_for(process.wait(), timeout)
+
+            except asyncio.TimeoutError:
+                print('  Killing', cmd, 'after', timeout, 'seconds')
+                _kill_group(process)
+                status = await process.wait()
+
+            except asyncio.CancelledError:
+                _kill_group(process)
+                await process.wait()
+                raise
+
+            finally:
+                if self.log_dir:
+                    await saving
+
+        finally:
+            self.running -= 1
+
+        if self.metrics:
+            self.metrics.runtime.observe(perf_counter() - start_time)
+
+        self.exit_statuses[status] += 1
+        return status
+
+    def _log_for(self, cmd):
+        """ Returns the log to write the output of the given command to """
+        if cmd not in self._logs:
+            # Readable prefix of the command and a hash to keep it unique
+            name = re.sub(r'[^\w.-]+', '_', cmd)[:50]
+            digest = sha1(cmd.encode()).hexdigest()[:8]
+            path = os.path.join(self.log_dir,
+                                '{}-{}.log'.format(name, digest))
+            self._logs[cmd] = RotatingLog(path, self.max_log_bytes,
+                                          self.log_backups)
+
+        return self._logs[cmd]
+
+    async def _save_output(self, stream, log):
+        """
+        Copy the stream to the log in chunks until it is closed.
+
+        If the log can't be written, the rest of the stream is read and
+        dropped, so the command doesn't block on a full pipe.
+        """
+        error = None
+        try:
+            while True:
+                chunk = await stream.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if error is None:
+                    try:
+                        log.write(chunk)
+                    except OSError as e:
+                        error = e
+
+        finally:
+            if error is None:
+                try:
+                    log.flush()
+                except OSError as e:
+                    error = e
+            if error:
+                print('  Failed to save output to', log.path, error)
+
+
+class RotatingLog:
+    """
+    Log file that is rotated to path.1, path.2, etc when it gets too big.
+
+    Writes are buffered in memory and written to the file in one batch when
+    the buffer is full, so memory used is capped by the buffer size.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3,
+                 buffer_size=64 * 1024):
+        """
+        :param str path: Path to the log file
+        :param int max_bytes: Max size of the file before it rotates
+        :param int backups: Number of rotated files to keep
+        :param int buffer_size: Number of bytes to buffer before writing
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer_size = buffer_size
+
+        self._buffer = bytearray()
+        self._size = None  # Size of the file, read when first flushed
+
+    def write(self, data):
+        """ Buffer the data and write the buffer out when it is full """
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Write out buffered data, rotating the file if needed """
+        if not self._buffer:
+            return
+
+        if self._size is None:
+            try:
+                self._size = os.path.getsize(self.path)
+            except OSError:
+                self._size = 0
+
+        if self._size and self._size + len(self._buffer) > self.max_bytes:
+            self._rotate()
+
+        try:
+            with open(self.path, 'ab') as fp:
+                fp.write(self._buffer)
+            self._size += len(self._buffer)
+
+        except OSError:
+            self._size = None  # Read it again as some may have been written
+            raise
+
+        finally:
+            # Drop data that can't be written so the buffer stays capped
+            self._buffer.clear()
+
+    def _rotate(self):
+        """ Shift the backups by one and start a new file """
+        for i in range(self.backups - 1, 0, -1):
+            backup = '{}.{}'.format(self.path, i)
+            if os.path.exists(backup):
+                os.replace(backup, '{}.{}'.format(self.path, i + 1))
+
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+        self._size = 0
+
+
+class Metrics:
+    """
+    Histograms of how late entries fire and how long commands run, and
+    gauges of what cron is doing, which can be dumped to a file in the
+    Prometheus text format.
+
+    .. code-block:: python
+
+        metrics = Metrics('cron.prom')
+        await cron(schedule, metrics=metrics)
+
+        metrics.snapshot()   # {'cron_fire_lag_seconds': {...}, ...}
+    """
+
+    #: Buckets for lag, in seconds
+    LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    #: Buckets for run time, in seconds
+    RUNTIME_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, 3600)
+
+    def __init__(self, path=None, interval=15):
+        """
+        :param str path: File to periodically dump the metrics to
+        :param float interval: Number of seconds between dumps
+        """
+        #: File to periodically dump the metrics to
+        self.path = path
+        self.interval = interval
+
+        #: Seconds between when entries were due and when they fired
+        self.fire_lag = Histogram(
+            'cron_fire_lag_seconds', 'Seconds from when an entry was due to '
+            'when it fired', self.LAG_BUCKETS)
+
+        #: Seconds between when commands were due and when they started
+        self.start_lag = Histogram(
+            'cron_start_lag_seconds', 'Seconds from when a command was due '
+            'to when it started', self.LAG_BUCKETS)
+
+        #: Seconds that commands ran for
+        self.runtime = Histogram(
+            'cron_command_runtime_seconds', 'Seconds that a command ran for',
+            self.RUNTIME_BUCKETS)
+
+        # Map of name to (description, function that returns the value)
+        self._gauges = {}
+
+    def gauge(self, name, description, value):
+        """
+        Add a gauge whose value is read when it is needed.
+
+        :param str name: Name of the gauge
+        :param str description: Description of the gauge
+        :param callable value: Returns the current value
+        """
+        self._gauges[name] = (description, value)
+
+    def snapshot(self):
+        """ Returns a map of name to the current value of each metric """
+        snapshot = {h.name: h.snapshot()
+                    for h in (self.fire_lag, self.start_lag, self.runtime)}
+        snapshot.update((name, value())
+                        for name, (_, value) in self._gauges.items())
+        return snapshot
+
+    def to_prometheus(self):
+        """ Returns the metrics in the Prometheus text format """
+        lines = []
+        for histogram in (self.fire_lag, self.start_lag, self.runtime):
+            lines.extend(histogram.to_prometheus())
+
+        for name, (description, value) in self._gauges.items():
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value()))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        """ Write the metrics to the file, replacing it in one step """
+        with open(self.path + '.tmp', 'w') as fp:
+            fp.write(self.to_prometheus())
+        os.replace(self.path + '.tmp', self.path)
+
+    async def dump_periodically(self):
+        """ Dump the metrics every interval until cancelled """
+        try:
+            while True:
+                self.dump()
+                await asyncio.sleep(self.interval)
+        finally:
+            self.dump()
+
+
+class Histogram:
+    """
+    Counts of values in fixed buckets. Counts are preallocated, so
+    recording a value is a binary search and an increment.
+    """
+
+    def __init__(self, name, description, buckets):
+        """
+        :param str name: Name of the histogram
+        :param str description: Description of the histogram
+        :param tuple buckets: Upper bound of each bucket, in ascending order
+        """
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+
+        #: Number of values in each bucket, with the last one for values
+        #: above the last upper bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+
+        #: Sum of all values
+        self.sum = 0
+
+    @property
+    def count(self):
+        """ Number of values recorded """
+        return sum(self.counts)
+
+    def observe(self, value):
+        """ Record the value """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        """ Returns a copy of the counts and sum """
+        return {'buckets': self.buckets, 'counts': list(self.counts),
+                'sum': self.sum, 'count': self.count}
+
+    def to_prometheus(self):
+        """ Returns lines of the histogram in the Prometheus text format """
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+
+        total = 0
+        for bucket, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bucket,
+                                                          total))
+
+        lines.append('{}_sum {}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, total))
+        return lines
+
+
+@lru_cache(maxsize=65536)
+def command_args(cmd):
+    """
+    Returns the args to run the command with directly, or None if it needs
+    to run through a shell.
+
+    :param str cmd: Shell command
+    """
+    if _SHELL_SYNTAX.search(cmd):
+        return None
+
+    try:
+        args = tuple(shlex.split(cmd))
+    except ValueError:
+        return None  # Let the shell report the error
+
+    # Shell builtins like `cd` or `exit` are not programs and neither are
+    # variable assignments like `FOO=1 ls`.
+    if not args or '=' in args[0] or not shutil.which(args[0]):
+        return None
+
+    return args
+
+
+# Characters that have a special meaning to the shell outside of quotes
+_SHELL_SYNTAX = re.compile(r'[|&;<>()$`\\*?\[\]#~{}\n!]')
+
+
+def _kill_group(process):
+    """ Kill the process group of the given process """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # Already exited
+
+
+def benchmark(expressions=50000, jobs=500):
+    """
+    Show how long it takes to compile cron expressions and find their next
+    runs, and to run commands with and without a shell.
+
+    :param int expressions: Number of random expressions to use
+    :param int jobs: Number of commands to run for each mode
+    """
+    _benchmark_expressions(expressions)
+
+    loop = asyncio.get_event_loop()
+    for use_shell in (True, False):
+        loop.run_until_complete(_benchmark_spawn(jobs, use_shell))
+
+
+def _benchmark_expressions(expressions):
+    rand = random.Random(0)
+
+    def field(low, high):
+        choice = rand.random()
+        if choice < 0.4:
+            return '*'
+        if choice < 0.6:
+            return '*/{}'.format(rand.randint(2, (high - low) // 2 + 1))
+        if choice < 0.8:
+            start = rand.randint(low, high)
+            return '{}-{}'.format(start, rand.randint(start, high))
+        return ','.join(str(v) for v in rand.sample(range(low, high + 1), 3))
+
+    lines = [' '.join(field(low, high) for low, high in
+                      ((0, 59), (0, 59), (0, 23), (1, 28), (1, 12), (0, 6)))
+             for _ in range(expressions)]
+
+    start_time = perf_counter()
+    triggers = [CronExpression(line) for line in lines]
+    duration = perf_counter() - start_time
+    print('Compiled {} expressions in {:.2f} seconds'.format(
+        expressions, duration))
+
+    now = time()
+    start_time = perf_counter()
+    for trigger in triggers:
+        trigger.next_after(now)
+    duration = perf_counter() - start_time
+    print('Computed {} next runs in {:.2f} seconds ({:.1f} us each)'.format(
+        expressions, duration, duration / expressions * 1e6))
 
-        if current_time in schedule:
-            print(current_time)
-            await asyncio.wait([_run_command(c)
-                                for c in schedule[current_time]])
 
-        await asyncio.sleep(60)
+async def _benchmark_spawn(jobs, use_shell):
+    """ Show how long it takes to start and run commands """
+    mode = 'shell' if use_shell else 'exec'
+    cmd = 'sleep 0'
+    args = None if use_shell else command_args(cmd)
 
+    # Latency of running one process at a time from start to exit
+    start_time = perf_counter()
+    for _ in range(jobs):
+        if args:
+            process = await asyncio.create_subprocess_exec(*args)
+        else:
+            process = await asyncio.create_subprocess_shell(cmd)
+        await process.wait()
+    duration = perf_counter() - start_time
+    print('{} mode: {:.2f} ms to run a process'.format(
+        mode, duration / jobs * 1e3))
 
-async def _run_command(cmd):
-    """ Run the given shell command """
-    print('  Running', cmd)
-    await asyncio.create_subprocess_shell(cmd)
+    # Throughput of running many at the same time
+    pool = ProcessPool(use_shell=use_shell)
+    start_time = perf_counter()
+    with redirect_stdout(None):
+        for _ in range(jobs):
+            pool.submit(cmd)
+        await pool.join()
+    duration = perf_counter() - start_time
+    await pool.close()
+    print('{} mode: {:.0f} jobs/second with {} running at a time'.format(
+        mode, jobs / duration, pool.max_running))
 
 
 def _current_time():
@@ -75,4 +1502,7 @@ def _current_time():
 
 
 if __name__ == "__main__":
-    main()
+    if '--benchmark' in sys.argv:
+        benchmark()
+    else:
+        main(*sys.argv[1:2])
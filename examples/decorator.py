@@ -24,13 +24,33 @@ Creating decorator with factor of  4
 multiply: Decorating <method 'lower' of 'str' objects>
 multiply: Wrapper called
 don't you? don't you? don't you? don't you?
+16 16 25
+CacheInfo(hits=1, misses=2, evictions=0, expired=0, size=2, bytes=0)
+1
+
+$ python3 examples/decorator.py --benchmark
+...
+Bare function:              119.3 ns per call
+Instrumented:              1091.8 ns per call
+Instrumented, disabled:      83.2 ns per call
+double:                     940.1 ns per call
 
 References
 -----------------------------------------------------------------------------
 https://www.python.org/dev/peps/pep-0318/
+https://docs.python.org/3/library/functools.html#functools.lru_cache
 """
 
+import asyncio
+from collections import namedtuple, OrderedDict
+from contextlib import redirect_stdout
 from functools import wraps
+import inspect
+import io
+import sys
+from threading import local, Lock
+from time import monotonic, perf_counter_ns
+from timeit import timeit
 
 
 def main():
@@ -50,6 +70,14 @@ def main():
     four = multiply(factor=4)(str.lower)    # Decorating <method 'lower' ...
     print(four('DON\'T YOU? '))  # don't you? don't you? don't you? don't you
 
+    # Decorators can also remember results so they are only computed once
+    print(square(4), square(4), square(5))  # 16 16 25
+    print(square.cache_info())   # CacheInfo(hits=1, misses=2, evictions=0...
+
+    # Or count calls and how long they took, cheap enough for hot paths
+    increment(1)
+    print(instrumented_stats()[__name__ + '.increment'].calls)  # 1
+
 
 def double(f):
     """
@@ -106,5 +134,338 @@ def mecho(value):
     return value
 
 
+#: Stats of a memoized function. Bytes are only estimated with `max_bytes`.
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions expired size '
+                                    'bytes')
+
+
+def memoize(max_entries=128, ttl=None, max_bytes=None, sizeof=None):
+    """
+    A decorator to remember results of a function by its args, so it is only
+    computed once, like `functools.lru_cache`, with expiry and a limit of
+    bytes. It works with `async def` functions too, where calls for the same
+    args while it is being computed wait for the same result.
+
+    Least recently used results are evicted when there are more than
+    `max_entries` or their estimated size adds up to more than `max_bytes`.
+
+    The decorated function has `cache_info()` to get `CacheInfo` stats and
+    `cache_clear()` to forget all results.
+
+    :param int max_entries: Max number of results to keep, or None for no
+                            limit
+    :param float ttl: Number of seconds to keep a result for, or None for
+                      no expiry
+    :param int max_bytes: Max number of bytes of results to keep, or None
+                          for no limit
+    :param sizeof: Function that returns the size of a result in bytes.
+                   Defaults to `sys.getsizeof`, which doesn't include the
+                   size of the objects that the result contains.
+    """
+    sizeof = sizeof or sys.getsizeof
+
+    def decorator(f):
+        # Map of key to (result, expires, size), from least recently used
+        results = OrderedDict()
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0,
+                 'bytes': 0}
+        lock = Lock()
+
+        def get(key):
+            """ Returns (True, result) if it is cached """
+            with lock:
+                entry = results.get(key)
+                if entry is None:
+                    stats['misses'] += 1
+                    return False, None
+
+                result, expires, size = entry
+                if expires is not None and monotonic() >= expires:
+                    del results[key]
+                    stats['bytes'] -= size
+                    stats['expired'] += 1
+                    stats['misses'] += 1
+                    return False, None
+
+                results.move_to_end(key)
+                stats['hits'] += 1
+                return True, result
+
+        def put(key, result):
+            size = sizeof(result) if max_bytes else 0
+            if max_bytes and size > max_bytes:
+                return  # Would evict everything else and still not fit
+
+            expires = monotonic() + ttl if ttl is not None else None
+            with lock:
+                if key in results:
+                    stats['bytes'] -= results.pop(key)[2]
+                results[key] = result, expires, size
+                stats['bytes'] += size
+
+                while is_full():
+                    _, (_, _, evicted_size) = results.popitem(last=False)
+                    stats['bytes'] -= evicted_size
+                    stats['evictions'] += 1
+
+        def is_full():
+            if max_entries is not None and len(results) > max_entries:
+                return True
+            return bool(max_bytes) and stats['bytes'] > max_bytes
+
+        def cache_info():
+            with lock:
+                return CacheInfo(size=len(results), **stats)
+
+        def cache_clear():
+            with lock:
+                results.clear()
+                stats['bytes'] = 0
+
+        if inspect.iscoroutinefunction(f):
+            # Map of key to the task computing its result
+            pending = {}
+
+            @wraps(f)
+            async def decorated(*args, **kwargs):
+                key = _make_key(args, kwargs)
+                found, result = get(key)
+                if found:
+                    return result
+
+                task = pending.get(key)
+                if task is None:
+                    task = asyncio.ensure_future(f(*args, **kwargs))
+                    pending[key] = task
+
+                    def done(task):
+                        del pending[key]
+                        if not task.cancelled() and not task.exception():
+                            put(key, task.result())
+
+                    task.add_done_callback(done)
+
+                # Shield so a cancelled caller doesn't cancel the others
+                return await asyncio.shield(task)
+
+        else:
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                key = _make_key(args, kwargs)
+                found, result = get(key)
+                if found:
+                    return result
+
+                result = f(*args, **kwargs)
+                put(key, result)
+                return result
+
+        decorated.cache_info = cache_info
+        decorated.cache_clear = cache_clear
+        return decorated
+
+    return decorator
+
+
+# Separates args from kwargs in keys, so f(1, 2) and f(1, b=2) differ
+_KWARGS_MARK = object()
+
+
+def _make_key(args, kwargs):
+    if not kwargs:
+        return args
+    return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+
+@memoize(max_entries=100)
+def square(value):
+    return value * value
+
+
+#: Stats of an instrumented function, merged from all threads. Buckets map
+#: the upper bound in nanoseconds, a power of 2, to the number of calls that
+#: took less than it.
+CallStats = namedtuple('CallStats', 'calls errors total_ns buckets')
+
+# Index of each counter in the list of counters for a thread. Latency
+# buckets come first, indexed by the bit length of nanoseconds, so no
+# offset needs to be added, and calls are counted as the sum of buckets.
+_ERRORS, _TOTAL_NS = 64, 65
+_COUNTERS = 66
+
+#: Wrappers of all instrumented functions
+_instrumented = []
+
+_instrumentation_enabled = True
+
+
+def instrument(f):
+    """
+    A decorator to count calls, errors and latency of a function, without
+    printing or locking, so it can be used on hot paths.
+
+    Each thread adds to its own preallocated list of counters, and they are
+    merged when stats are read with `instrumented_stats()`.
+
+    When instrumentation is disabled with `set_instrumentation(False)`, the
+    function is rebound to the original, so there is no cost at all. Only
+    functions defined in a module or class are rebound, and names imported
+    from the module before that keep what they were bound to.
+    """
+    instrumented = _instrument(f)
+    _instrumented.append(instrumented)
+
+    return instrumented if _instrumentation_enabled else f
+
+
+def _instrument(f):
+    """ Returns the wrapper for `instrument` without registering it """
+    thread_counters = local()
+    all_counters = []
+    lock = Lock()
+
+    def new_counters():
+        counters = thread_counters.counters = [0] * _COUNTERS
+        with lock:
+            all_counters.append(counters)
+        return counters
+
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def instrumented(*args, **kwargs):
+            try:
+                counters = thread_counters.counters
+            except AttributeError:
+                counters = new_counters()
+
+            start_time = perf_counter_ns()
+            try:
+                return await f(*args, **kwargs)
+            except BaseException:
+                counters[_ERRORS] += 1
+                raise
+            finally:
+                duration = perf_counter_ns() - start_time
+                counters[duration.bit_length()] += 1
+                counters[_TOTAL_NS] += duration
+
+    else:
+        @wraps(f)
+        def instrumented(*args, **kwargs):
+            try:
+                counters = thread_counters.counters
+            except AttributeError:
+                counters = new_counters()
+
+            start_time = perf_counter_ns()
+            try:
+                return f(*args, **kwargs)
+            except BaseException:
+                counters[_ERRORS] += 1
+                raise
+            finally:
+                duration = perf_counter_ns() - start_time
+                counters[duration.bit_length()] += 1
+                counters[_TOTAL_NS] += duration
+
+    def stats():
+        with lock:
+            totals = [sum(values) for values in zip(*all_counters)]
+        if not totals:
+            return CallStats(0, 0, 0, {})
+
+        buckets = {2 ** bit_length: count for bit_length, count
+                   in enumerate(totals[:_ERRORS]) if count}
+        return CallStats(sum(buckets.values()), totals[_ERRORS],
+                         totals[_TOTAL_NS], buckets)
+
+    instrumented.stats = stats
+    return instrumented
+
+
+def instrumented_stats():
+    """
+    Returns a dict of module and qualified function name, such as
+    'examples.decorator.increment', to its `CallStats`
+    """
+    return {wrapper.__module__ + '.' + wrapper.__qualname__: wrapper.stats()
+            for wrapper in _instrumented}
+
+
+def set_instrumentation(enabled):
+    """
+    Enable or disable instrumentation by rebinding instrumented functions
+    to their wrappers or original functions.
+
+    :param bool enabled: Enable instrumentation
+    """
+    global _instrumentation_enabled
+    _instrumentation_enabled = enabled
+
+    for wrapper in _instrumented:
+        original = wrapper.__wrapped__
+        owner = _owner(original)
+        name = original.__name__
+        bound = getattr(owner, name, None)
+        if owner is not None and bound in (wrapper, original):
+            setattr(owner, name, wrapper if enabled else original)
+
+
+def _owner(f):
+    """ Returns the module or class that the function is defined in """
+    path = f.__qualname__.split('.')[:-1]
+    if '<locals>' in path:
+        return None
+
+    owner = sys.modules.get(f.__module__)
+    for name in path:
+        owner = getattr(owner, name, None)
+    return owner
+
+
+@instrument
+def increment(value):
+    return value + 1
+
+
+def benchmark(calls=1000000):
+    """
+    Show the overhead per call of `instrument`, enabled and disabled,
+    compared to the bare function and to `double`.
+
+    :param int calls: Number of calls to time for each
+    """
+    def bare(value):
+        return value + 1
+
+    doubled = double(bare)
+
+    # Not registered, so it isn't in the stats or rebound by
+    # `set_instrumentation`
+    instrumented = _instrument(bare)
+    module = sys.modules[__name__]
+
+    def run(title, func):
+        # `double` prints on every call, so hide it
+        with redirect_stdout(io.StringIO()):
+            per_call = timeit(lambda: func(1), number=calls) / calls * 1e9
+        print('{:<24} {:>8.1f} ns per call'.format(title + ':', per_call))
+
+    run('Bare function', bare)
+    run('Instrumented', instrumented)
+
+    set_instrumentation(False)
+    try:
+        # Rebound to the original function
+        run('Instrumented, disabled', module.increment)
+    finally:
+        set_instrumentation(True)
+
+    run('double', doubled)
+
+
 if __name__ == "__main__":
-    main()
+    if '--benchmark' in sys.argv:
+        benchmark()
+    else:
+        main()
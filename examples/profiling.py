@@ -0,0 +1,241 @@
+"""
+Profiling any example without changing its code
+=============================================================================
+
+The launcher runs an example as if it was run directly, with one of these
+profilers, and saves the results to files that can be compared later:
+
+* cprofile: Time spent per function with `cProfile`, saved as pstats
+  (.prof) and as text sorted by cumulative time (.txt).
+* sample: Stacks sampled at an interval of CPU time from a signal timer,
+  which slows the code down much less than `cProfile`. Saved as folded
+  stacks (.folded) for flame graphs, and as text of the functions that
+  are sampled the most (.txt).
+* memory: Lines that allocated the most memory still in use at the end
+  with `tracemalloc`, saved as a snapshot (.snapshot) and as text (.txt).
+
+The profiler is chosen with `--profile` or the `PROFILE` environment
+variable, and the output dir with `--profile-dir` or `PROFILE_DIR`.
+
+Example Run
+-----------------------------------------------------------------------------
+$ python3 profiling.py --profile=sample cron.py --benchmark
+Compiled 50000 expressions in 1.57 seconds
+...
+Saved profile to profiles/cron-sample-20261018-190830-28809.txt
+
+$ head -4 profiles/cron-sample-20261018-190830-28809.txt
+1022 samples every 1.0 ms of CPU time
+  self   total  function
+   318     318  cron.py:_parse_field
+    58     173  cron.py:field
+
+$ PROFILE=memory python3 profiling.py async_http_requests.py --local
+...
+Saved profile to profiles/async_http_requests-memory-20261018-190843-1458.txt
+
+Snapshots from the memory profiler can be compared to find what grew:
+
+>>> import tracemalloc
+>>> old = tracemalloc.Snapshot.load('profiles/cron-memory-1.snapshot')
+>>> new = tracemalloc.Snapshot.load('profiles/cron-memory-2.snapshot')
+>>> new.compare_to(old, 'lineno')[:10]
+
+References
+-----------------------------------------------------------------------------
+https://docs.python.org/3/library/profile.html
+https://docs.python.org/3/library/signal.html#signal.setitimer
+https://docs.python.org/3/library/tracemalloc.html
+https://www.brendangregg.com/flamegraphs.html
+"""
+
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import os
+import pstats
+import runpy
+import signal
+import sys
+from time import strftime
+import tracemalloc
+
+
+#: Names of the profilers
+PROFILERS = ('cprofile', 'sample', 'memory')
+
+
+def main(argv=None):
+    """
+    Run an example with a profiler.
+
+    :param list argv: Args of the launcher, followed by the example's
+                      script and its args. Defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(
+        description='Run an example with a profiler')
+    parser.add_argument('--profile', choices=PROFILERS,
+                        default=os.environ.get('PROFILE', 'cprofile'),
+                        help='Profiler to use [env: PROFILE]')
+    parser.add_argument('--profile-dir',
+                        default=os.environ.get('PROFILE_DIR', 'profiles'),
+                        help='Dir to save results to [env: PROFILE_DIR]')
+    parser.add_argument('--interval', type=float, default=0.001,
+                        help='Number of seconds of CPU time between samples')
+    parser.add_argument('script', help='Example to run, such as cron.py')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='Args for the example')
+    args = parser.parse_args(argv)
+
+    script = args.script
+    if not os.path.exists(script) and not script.endswith('.py'):
+        script += '.py'
+    name = os.path.splitext(os.path.basename(script))[0]
+
+    # Run it like `python3 script.py args`
+    sys.argv = [script] + args.args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+
+    with profiled(args.profile, args.profile_dir, name, args.interval):
+        runpy.run_path(script, run_name='__main__')
+
+
+@contextmanager
+def profiled(profiler, output_dir='profiles', name='profile',
+             interval=0.001):
+    """
+    Profile the enclosed code and save the results when it is done, even if
+    it is interrupted.
+
+    :param str profiler: Name of the profiler, one of `PROFILERS`
+    :param str output_dir: Dir to save results to
+    :param str name: Name of what is profiled, used to name the files
+    :param float interval: Number of seconds of CPU time between samples
+                           for the sample profiler
+    """
+    if profiler not in PROFILERS:
+        raise ValueError('Unknown profiler {!r}, use one of: {}'.format(
+            profiler, ', '.join(PROFILERS)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, '{}-{}-{}-{}'.format(
+        name, profiler, strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            _save_cprofile(profile, path)
+
+    elif profiler == 'sample':
+        sampler = Sampler(interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.save(path)
+
+    else:
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            _save_snapshot(snapshot, path)
+
+    print('Saved profile to', path + '.txt', file=sys.stderr)
+
+
+def _save_cprofile(profile, path):
+    profile.dump_stats(path + '.prof')
+    with open(path + '.txt', 'w') as fp:
+        stats = pstats.Stats(profile, stream=fp)
+        stats.sort_stats('cumulative').print_stats(50)
+
+
+def _save_snapshot(snapshot, path):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ])
+    snapshot.dump(path + '.snapshot')
+
+    stats = snapshot.statistics('lineno')
+    with open(path + '.txt', 'w') as fp:
+        total = sum(stat.size for stat in stats)
+        fp.write('{:.1f} KiB in use from {} lines\n'.format(
+            total / 1024, len(stats)))
+        for stat in stats[:50]:
+            frame = stat.traceback[0]
+            fp.write('{:>10.1f} KiB {:>8} blocks  {}:{}\n'.format(
+                stat.size / 1024, stat.count, frame.filename, frame.lineno))
+
+
+class Sampler:
+    """
+    Profiler that samples the stack of the main thread at an interval of
+    CPU time, using the SIGPROF signal timer, so time spent waiting, such
+    as for I/O in an event loop, is not sampled.
+
+    Only works on Unix, from the main thread.
+    """
+
+    def __init__(self, interval=0.001):
+        """
+        :param float interval: Number of seconds of CPU time between samples
+        """
+        self.interval = interval
+
+        #: Number of samples per stack, from the outermost function
+        self.stacks = Counter()
+
+        self._old_handler = None
+
+    def start(self):
+        self._old_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame:
+            code = frame.f_code
+            stack.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                        code.co_name))
+            frame = frame.f_back
+        self.stacks[tuple(reversed(stack))] += 1
+
+    def save(self, path):
+        """ Save folded stacks to path.folded and a summary to path.txt """
+        with open(path + '.folded', 'w') as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write('{} {}\n'.format(';'.join(stack), count))
+
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for function in set(stack):
+                total_counts[function] += count
+
+        with open(path + '.txt', 'w') as fp:
+            fp.write('{} samples every {:.1f} ms of CPU time\n'.format(
+                sum(self.stacks.values()), self.interval * 1000))
+            fp.write('{:>6} {:>7}  function\n'.format('self', 'total'))
+            for function, count in self_counts.most_common(50):
+                fp.write('{:>6} {:>7}  {}\n'.format(
+                    count, total_counts[function], function))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,267 @@
 from contextlib import contextmanager
-from time import time
+from contextvars import ContextVar
+from functools import wraps
+import inspect
+from time import perf_counter_ns
+
+
+#: Path of the span that code is running in, such as 'request/parse'.
+#: Each async task gets a copy when it is created, so spans in concurrent
+#: tasks nest under the span that created them without mixing.
+_current_span = ContextVar('current_span', default=None)
+
+
+class Timer:
+    """
+    Registry of timings for named spans of code, which can be left on in hot
+    paths as it only keeps aggregates.
+
+    .. code-block:: python
+
+        with timer.span('request'):
+            async with timer.span('fetch'):     # Recorded as 'request/fetch'
+                ...
+
+        @timer.timed()
+        def parse(text):
+            ...
+
+        print(timer.report())
+
+    When disabled, spans do nothing besides returning a shared no-op span.
+    """
+
+    def __init__(self, enabled=True):
+        """
+        :param bool enabled: Record spans. Can be changed at any time.
+        """
+        self.enabled = enabled
+
+        # Map of span path to its Timing
+        self._timings = {}
+
+    def span(self, name):
+        """
+        Returns a context manager, sync or async, that times the code in it.
+
+        :param str name: Name of the span. It is recorded under the path of
+                         the spans that it is nested in.
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return Span(self, name)
+
+    def timed(self, name=None):
+        """
+        Decorator to time each call of a function or coroutine function.
+
+        :param str name: Name of the span. Defaults to the function's name.
+        """
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            if inspect.iscoroutinefunction(func):
+                @wraps(func)
+                async def timed_func(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    with Span(self, span_name):
+                        return await func(*args, **kwargs)
+
+            else:
+                @wraps(func)
+                def timed_func(*args, **kwargs):
+                    if not self.enabled:
+                        return func(*args, **kwargs)
+                    with Span(self, span_name):
+                        return func(*args, **kwargs)
+
+            return timed_func
+
+        return decorator
+
+    def record(self, path, duration_ns):
+        """
+        Add a duration for the span path.
+
+        :param str path: Path of the span
+        :param int duration_ns: Number of nanoseconds it took
+        """
+        timing = self._timings.get(path)
+        if timing is None:
+            timing = self._timings.setdefault(path, Timing())
+        timing.add(duration_ns)
+
+    def timing(self, path):
+        """ Returns the Timing for the span path, or None if missing """
+        return self._timings.get(path)
+
+    def reset(self):
+        """ Forget all timings """
+        self._timings = {}
+
+    def export(self):
+        """
+        Returns the timings as a dict that can be saved as JSON, such as:
+
+        {'request/fetch': {'count': 2, 'total_ns': 3000, 'min_ns': 1000,
+                           'max_ns': 2000, 'buckets': {1024: 1, 2048: 1}}}
+
+        Buckets map the upper bound in nanoseconds, a power of 2, to the
+        number of spans that took less than it.
+        """
+        return {path: timing.export()
+                for path, timing in sorted(self._timings.items())}
+
+    def report(self):
+        """ Returns a table of the timings in milliseconds """
+        lines = ['{:<40} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+            'span', 'count', 'total', 'mean', 'min', 'p99', 'max')]
+
+        for path, timing in sorted(self._timings.items()):
+            lines.append(
+                '{:<40} {:>8} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.3f} '
+                '{:>9.3f}'.format(
+                    path, timing.count, timing.total_ns / 1e6,
+                    timing.mean_ns() / 1e6, timing.min_ns / 1e6,
+                    timing.percentile_ns(0.99) / 1e6, timing.max_ns / 1e6))
+
+        return '\n'.join(lines)
+
+
+class Span:
+    """ Span of code that is timed by a `Timer` """
+
+    __slots__ = ('timer', 'name', 'path', 'duration_ns', '_start', '_token')
+
+    def __init__(self, timer, name):
+        """
+        :param Timer timer: Timer to record to
+        :param str name: Name of the span
+        """
+        self.timer = timer
+        self.name = name
+
+        #: Path of the span, including the spans it is nested in
+        self.path = None
+
+        #: Number of nanoseconds the span took, once it is done
+        self.duration_ns = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.path = parent + '/' + self.name if parent else self.name
+        self._token = _current_span.set(self.path)
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration_ns = perf_counter_ns() - self._start
+        _current_span.reset(self._token)
+        self.timer.record(self.path, self.duration_ns)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        self.__exit__(*exc_info)
+
+
+class _NoSpan:
+    """ Span that does nothing, for when the timer is disabled """
+
+    __slots__ = ()
+
+    path = None
+    duration_ns = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Timing:
+    """
+    Aggregate of the durations of a span, with a histogram of buckets that
+    double in size, so it stays small no matter how many are added.
+    """
+
+    __slots__ = ('count', 'total_ns', 'min_ns', 'max_ns', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+
+        #: Number of durations by their bit length, so bucket `i` counts
+        #: durations less than 2 ** i nanoseconds.
+        self.buckets = [0] * 64
+
+    def add(self, duration_ns):
+        """ Add a duration in nanoseconds """
+        if not self.count or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+        self.count += 1
+        self.total_ns += duration_ns
+        self.buckets[min(duration_ns.bit_length(), 63)] += 1
+
+    def mean_ns(self):
+        return self.total_ns / self.count if self.count else 0
+
+    def percentile_ns(self, ratio):
+        """
+        Returns the upper bound of the bucket that the percentile is in,
+        capped by the max.
+
+        :param float ratio: Percentile from 0 to 1
+        """
+        rank = ratio * self.count
+        seen = 0
+        for bit_length, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** bit_length, self.max_ns)
+        return self.max_ns
+
+    def export(self):
+        return {'count': self.count, 'total_ns': self.total_ns,
+                'min_ns': self.min_ns, 'max_ns': self.max_ns,
+                'buckets': {2 ** bit_length: count for bit_length, count
+                            in enumerate(self.buckets) if count}}
+
+
+#: Default timer
+timer = Timer()
 
 
 @contextmanager
 def show_duration(title, extra_newline=False):
     """
-    Print how long it took in seconds for enclosed code.
+    Print how long it took in seconds for enclosed code, and record it as a
+    span of the default timer.
 
     :param str title: Title for what we are measuring
     :param bool extra_newline: Add an extra newline to make things look
                                separated
     """
-    start_time = time()
-    yield
-    duration = time() - start_time
+    start_time = perf_counter_ns()
+    with timer.span(title):
+        yield
+    duration = (perf_counter_ns() - start_time) / 1e9
     print(f'{title} took {duration:.2f} seconds')
 
     if extra_newline:
@@ -20,7 +20,7 @@ setuptools.setup(
     packages=['examples'],
     include_package_data=True,
 
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     setup_requires=['setuptools-git'],
 
     classifiers=[
@@ -32,7 +32,7 @@ setuptools.setup(
       'License :: OSI Approved :: MIT License',
 
       'Programming Language :: Python :: 3',
-      'Programming Language :: Python :: 3.6',
+      'Programming Language :: Python :: 3.7',
     ],
 
     keywords='learn python by example',
@@ -0,0 +1,454 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+
+from aiohttp import web
+import pytest
+
+# The example imports `utils` the same way as when it is run from its dir
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                'examples'))
+from async_http_requests import (  # noqa: E402
+    AdaptiveLimit, benchmark, ChunkHasher, ChunkWriter, Fetcher,
+    LineSplitter, LocalServer, ResponseCache, RetryPolicy)
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+async def start_server(routes):
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, 'http://{}:{}'.format(host, port)
+
+
+def test_fetcher():
+    active = 0
+    max_active = 0
+
+    async def hello(request):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return web.Response(text='hello')
+
+    async def slow(request):
+        await asyncio.sleep(1)
+        return web.Response(text='slow')
+
+    async def test():
+        runner, url = await start_server([web.get('/', hello),
+                                          web.get('/slow', slow)])
+        try:
+            async with Fetcher(concurrency=3) as fetcher:
+                response = await fetcher.fetch(url)
+                assert response.status == 200
+                assert response.text() == 'hello'
+
+                responses = [r async for r in fetcher.fetch_all([url] * 10)]
+                assert [r.status for r in responses] == [200] * 10
+
+                with pytest.raises(asyncio.TimeoutError):
+                    await fetcher.fetch(url + '/slow', timeout=0.05)
+
+                errors = [r async for r in fetcher.fetch_all(
+                    [url + '/slow'], return_exceptions=True, timeout=0.05)]
+                assert isinstance(errors[0], asyncio.TimeoutError)
+        finally:
+            await runner.cleanup()
+
+    run(test())
+    assert max_active == 3
+
+
+def test_response_cache(tmpdir):
+    requests = []
+
+    async def page(request):
+        requests.append(request.path)
+        headers = {'ETag': '"v1"', 'Cache-Control': request.query['cache']}
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers=headers)
+        return web.Response(text='page', headers=headers)
+
+    async def test():
+        runner, url = await start_server([web.get('/{name}', page)])
+        cache = ResponseCache(cache_dir=str(tmpdir))
+        try:
+            async with Fetcher(cache=cache) as fetcher:
+                fresh = url + '/fresh?cache=max-age=60'
+                for _ in range(3):
+                    response = await fetcher.fetch(fresh)
+                    assert response.text() == 'page'
+                assert requests == ['/fresh']
+
+                stale = url + '/stale?cache=no-cache'
+                for _ in range(3):
+                    response = await fetcher.fetch(stale)
+                    assert response.status == 200
+                    assert response.text() == 'page'
+                assert requests == ['/fresh'] + ['/stale'] * 3
+
+                await fetcher.fetch(url + '/never?cache=no-store')
+                await fetcher.fetch(url + '/never?cache=no-store')
+                assert requests[-2:] == ['/never'] * 2
+
+                assert (cache.hits, cache.revalidated, cache.misses) == (
+                    2, 2, 4)
+                assert len(cache) == 2
+
+            # Loaded back from disk
+            async with Fetcher(cache=ResponseCache(
+                    cache_dir=str(tmpdir))) as fetcher:
+                response = await fetcher.fetch(fresh)
+                assert response.text() == 'page'
+                assert fetcher.cache.hits == 1
+        finally:
+            await runner.cleanup()
+
+    run(test())
+
+
+def test_response_cache_key():
+    async def echo(request):
+        headers = {'Cache-Control': 'max-age=60'}
+        if request.path == '/vary':
+            headers['Vary'] = 'Accept-Language'
+        return web.Response(text='{} {} {}'.format(
+            request.query_string, request.headers.get('Authorization'),
+            request.headers.get('Accept-Language')), headers=headers)
+
+    async def test():
+        runner, url = await start_server([web.get('/{name}', echo)])
+        try:
+            async with Fetcher(cache=ResponseCache()) as fetcher:
+                async def text(path, **kwargs):
+                    return (await fetcher.fetch(url + path, **kwargs)).text()
+
+                # Query params are part of the key
+                assert await text('/page', params={'p': '1'}) == \
+                    'p=1 None None'
+                assert await text('/page', params={'p': '2'}) == \
+                    'p=2 None None'
+                assert await text('/page?p=1') == 'p=1 None None'
+
+                # Responses are not shared between users
+                for user in ('alice', 'bob', 'alice'):
+                    assert await text('/page', headers={
+                        'Authorization': user}) == ' {} None'.format(user)
+
+                # Vary headers need to match
+                for language in ('en', 'fr', 'fr'):
+                    assert await text('/vary', headers={
+                        'Accept-Language': language}) == ' None ' + language
+
+                assert fetcher.cache.hits == 3
+                assert fetcher.cache.misses == 6
+        finally:
+            await runner.cleanup()
+
+    run(test())
+
+
+def test_response_cache_evicts_to_max_bytes():
+    class FakeResponse:
+        status = 200
+        headers = {'Cache-Control': 'max-age=60'}
+
+        def __init__(self, url, size):
+            self.url = url
+            self.body = b'x' * size
+
+    cache = ResponseCache(max_bytes=500)
+    for i in range(5):
+        url = 'http://example.com/{}'.format(i)
+        cache.store(url, FakeResponse(url, 150))
+        cache.get('http://example.com/0')
+
+    assert list(cache._entries) == ['http://example.com/4',
+                                    'http://example.com/0']
+    assert cache.size <= 500
+
+
+def test_download(tmpdir):
+    body = ''.join('line {} é\r\n'.format(i) for i in range(20000))
+    body = body.encode()
+
+    async def big(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for i in range(0, len(body), 1000):
+            await response.write(body[i:i + 1000])
+        return response
+
+    async def test():
+        runner, url = await start_server([web.get('/', big)])
+        try:
+            async with Fetcher() as fetcher:
+                hasher = ChunkHasher()
+                response = await fetcher.download(url, hasher)
+                assert response.status == 200
+                assert response.size == len(body)
+                assert hasher.hexdigest() == hashlib.sha256(body).hexdigest()
+
+                path = str(tmpdir.join('body'))
+                await fetcher.download(url, ChunkWriter(path), chunk_size=7)
+                with open(path, 'rb') as fp:
+                    assert fp.read() == body
+
+                # Decoded chunks are written back as UTF-8 as is
+                await fetcher.download(url, ChunkWriter(path), chunk_size=7,
+                                       encoding='auto')
+                with open(path, 'rb') as fp:
+                    assert fp.read() == body
+
+                # Closed when the download fails
+                class FailingWriter(ChunkWriter):
+                    def __call__(self, chunk):
+                        super().__call__(chunk)
+                        raise ValueError('Disk full')
+
+                writer = FailingWriter(path)
+                with pytest.raises(ValueError):
+                    await fetcher.download(url, writer)
+                assert writer._file is None
+
+                # Characters and line endings split between chunks
+                for encoding in ('auto', None):
+                    lines = []
+                    await fetcher.download(url, LineSplitter(lines.append),
+                                           chunk_size=3, encoding=encoding)
+                    text = [line.decode() if encoding is None else line
+                            for line in lines]
+                    assert text == body.decode().split('\r\n')[:-1]
+
+                async with fetcher.stream(url) as response:
+                    chunks = [c async for c in response.iter_chunks(4096)]
+                    assert max(len(c) for c in chunks) <= 4096
+                    assert b''.join(chunks) == body
+        finally:
+            await runner.cleanup()
+
+    run(test())
+
+
+def test_line_splitter():
+    body = 'page1\x0cpage2\r\nx\u2028y\n\r\nlast\r'
+    for data in (body, body.encode()):
+        lines = []
+        splitter = LineSplitter(lines.append)
+        for i in range(0, len(data), 2):
+            splitter(data[i:i + 2])
+        splitter.close()
+
+        if isinstance(data, bytes):
+            lines = [line.decode() for line in lines]
+        assert lines == ['page1\x0cpage2', 'x\u2028y', '', 'last']
+
+
+def test_coalesce():
+    requests = []
+
+    async def slow(request):
+        requests.append(request.headers.get('X-Version'))
+        await asyncio.sleep(0.1)
+        return web.Response(text='slow')
+
+    async def test():
+        runner, url = await start_server([web.get('/', slow)])
+        try:
+            async with Fetcher(coalesce=True) as fetcher:
+                responses = await asyncio.gather(*[
+                    fetcher.fetch(url) for _ in range(10)])
+                assert len(set(map(id, responses))) == 1
+                assert responses[0].text() == 'slow'
+                assert fetcher.coalesced == 9
+                assert len(requests) == 1
+
+                # Different headers, opted out, and a new burst each
+                # make their own request
+                await asyncio.gather(
+                    fetcher.fetch(url, headers={'X-Version': '1'}),
+                    fetcher.fetch(url, headers={'x-version': '1'}),
+                    fetcher.fetch(url, headers={'X-Version': '2'}),
+                    fetcher.fetch(url, coalesce=False))
+                await fetcher.fetch(url)
+                assert sorted(requests, key=str) == [
+                    '1', '2', None, None, None]
+                assert fetcher.coalesced == 10
+
+                # A cancelled caller doesn't cancel the shared request
+                first = asyncio.ensure_future(fetcher.fetch(url))
+                second = asyncio.ensure_future(fetcher.fetch(url))
+                await asyncio.sleep(0.01)
+                first.cancel()
+                assert (await second).status == 200
+                assert not fetcher._in_flight
+        finally:
+            await runner.cleanup()
+
+    run(test())
+
+
+def test_adaptive_limit():
+    limit = AdaptiveLimit(initial=2, min_limit=1, max_limit=3)
+
+    async def test():
+        first = await limit.acquire()
+        second = await limit.acquire()
+        waiting = asyncio.ensure_future(limit.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        # Grows by about one per round
+        limit.release(first)
+        assert limit.limit == 2.5
+        third = await waiting
+        limit.release(second)
+        limit.release(third)
+        assert limit.limit == 3
+
+        # Cut once for requests in flight at the same time
+        started = [await limit.acquire() for _ in range(3)]
+        for start in started:
+            limit.release(start, overloaded=True)
+        assert limit.limit == 1.5
+        assert limit.decreases == 1
+
+        start = await limit.acquire()
+        limit.release(start, overloaded=True)
+        assert limit.limit == 1
+        assert limit.in_flight == 0
+
+        # Cancelled waiters don't take a slot
+        start = await limit.acquire()
+        cancelled = asyncio.ensure_future(limit.acquire())
+        waiting = asyncio.ensure_future(limit.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        limit.release(start, overloaded=None)
+        await waiting
+        assert limit.in_flight == 1
+        assert limit.limit == 1
+
+    run(test())
+
+
+def test_adaptive_fetcher():
+    active = 0
+
+    async def limited(request):
+        nonlocal active
+        if active >= 8:
+            return web.Response(status=503)
+        active += 1
+        await asyncio.sleep(0.01)
+        active -= 1
+        return web.Response(text='ok')
+
+    async def test():
+        runner, url = await start_server([web.get('/', limited)])
+        try:
+            limit = AdaptiveLimit(initial=4, max_limit=50)
+            retry = RetryPolicy(backoff=0.01, budget_ratio=1)
+            async with Fetcher(adaptive=limit, retry=retry) as fetcher:
+                statuses = [r.status async for r in
+                            fetcher.fetch_all([url] * 300)]
+        finally:
+            await runner.cleanup()
+
+        assert statuses == [200] * 300
+        assert limit.decreases
+        assert limit.limit < 20
+        assert retry.retried
+
+    run(test())
+
+
+def test_retry():
+    calls = 0
+
+    async def flaky(request):
+        nonlocal calls
+        calls += 1
+        if calls % 3:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return web.Response(text='ok')
+
+    async def test():
+        runner, url = await start_server([web.route('*', '/', flaky)])
+        try:
+            retry = RetryPolicy(backoff=0.001, max_budget=2)
+            async with Fetcher(retry=retry) as fetcher:
+                assert (await fetcher.fetch(url)).status == 200
+                assert retry.retried == 2
+
+                # Not idempotent
+                assert (await fetcher.fetch(url, 'POST')).status == 503
+
+                # Budget is used up
+                assert (await fetcher.fetch(url)).status == 503
+                assert retry.retried == 2
+                assert retry.exhausted == 1
+        finally:
+            await runner.cleanup()
+
+    run(test())
+
+
+def test_retry_delay():
+    retry = RetryPolicy(backoff=1, max_backoff=5)
+    for attempt in range(5):
+        assert 0 <= retry.delay(attempt) <= min(5, 2 ** attempt)
+    assert retry.delay(0, retry_after='3') == 3
+    assert retry.delay(0, retry_after='30') == 5
+    assert retry.delay(0, retry_after='Wed, 21 Oct 2015') <= 1
+
+
+def test_local_server():
+    async def test():
+        async with LocalServer(latency=0, body_size=5) as server:
+            async with Fetcher() as fetcher:
+                response = await fetcher.fetch(server.url)
+                assert response.body == b'xxxxx'
+
+                response = await fetcher.fetch(server.url + '?size=2')
+                assert response.body == b'xx'
+
+                response = await fetcher.fetch(server.url + '?error_rate=1')
+                assert response.status == 503
+
+                with pytest.raises(asyncio.TimeoutError):
+                    await fetcher.fetch(server.url + '?latency=1',
+                                        timeout=0.05)
+
+            assert server.requests == 4
+            assert server.errors == 1
+            assert len(server.peers) == 1
+
+    run(test())
+
+
+def test_benchmark(capsys):
+    results = benchmark(levels=(1, 5), requests=20, latency=0.001,
+                        error_rate=0.5)
+
+    output = json.loads(capsys.readouterr().out)
+    assert output['results'] == results
+    assert [r['concurrency'] for r in results] == [1, 5]
+    for result in results:
+        assert result['requests'] == 20
+        assert 0 < result['errors'] < 20
+        assert result['sockets'] == result['max_in_flight'] == \
+            result['concurrency']
+        assert set(result['latency_ms']) == {'p50', 'p95', 'p99'}
@@ -1,5 +1,12 @@
+import asyncio
+import os
 import re
-from examples.async_worker import main, AsyncManager
+from functools import partial
+from time import sleep
+
+import pytest
+
+from examples.async_worker import main, AsyncManager, Batcher, ShardedManager
 
 
 def test_async_worker(capsys):
@@ -11,3 +18,328 @@ def test_async_worker(capsys):
                         'Done with Task 0 after 0.003 seconds!\n',
                         captured.out,
                         flags=re.MULTILINE | re.DOTALL)
+
+
+def test_progress_interval(capsys):
+    AsyncManager._TASK_DURATION = 0.001
+    manager = AsyncManager(3, progress_interval=1)
+    asyncio.get_event_loop().run_until_complete(
+        manager.do_things_concurrently())
+
+    # Changes while waiting for the interval are not shown
+    captured = capsys.readouterr()
+    assert captured.out.count('running tasks]') == 1
+
+
+def test_process():
+    manager = AsyncManager(3)
+    results = []
+    pulled = []
+
+    def jobs():
+        for i in range(20):
+            pulled.append(i)
+
+            async def job(i=i):
+                # Jobs are pulled only as fast as workers take them
+                assert len(pulled) <= i + 3 + 6 + 1
+                await asyncio.sleep(0)
+                return i
+
+            yield job
+
+    done = asyncio.get_event_loop().run_until_complete(
+        manager.process(jobs(), on_result=results.append))
+
+    assert done == 20
+    assert sorted(results) == list(range(20))
+    assert manager._running_tasks == 0
+
+
+def test_process_async_jobs():
+    async def jobs():
+        for i in range(5):
+            async def job(i=i):
+                return i * 2
+            yield job
+
+    results = []
+    done = asyncio.get_event_loop().run_until_complete(
+        AsyncManager(2).process(jobs(), on_result=results.append))
+
+    assert done == 5
+    assert sorted(results) == [0, 2, 4, 6, 8]
+
+
+def test_blocking_and_cpu_jobs():
+    manager = AsyncManager(3, processes=2, cpu_batch_size=4)
+    results = []
+
+    jobs = [manager.cpu(pow, 2, n) for n in range(10)]
+    jobs.append(manager.blocking(sleep, 0.01))
+    done = asyncio.get_event_loop().run_until_complete(
+        manager.process(jobs, workers=20, on_result=results.append))
+    manager.close()
+
+    assert done == 11
+    assert sorted(results, key=str) == sorted(
+        [2 ** n for n in range(10)] + [None], key=str)
+
+    # 10 jobs in batches of up to 4
+    assert manager.cpu_batches == 3
+
+
+def test_cpu_job_error():
+    manager = AsyncManager(1)
+
+    async def run():
+        with pytest.raises(ZeroDivisionError):
+            await manager.run_cpu(divmod, 1, 0)
+        return await manager.run_cpu(divmod, 7, 2)
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == (3, 1)
+    manager.close()
+
+
+def test_submit_priority_and_deadline():
+    manager = AsyncManager(1, aging=10)
+    order = []
+
+    def job(name):
+        async def run():
+            order.append(name)
+            await asyncio.sleep(0.01)
+            return name
+        return run
+
+    async def run():
+        first = manager.submit(job('first'))
+        bulk = manager.submit(job('bulk'), priority=1)
+        urgent = manager.submit(job('urgent'))
+        expired = manager.submit(job('expired'), deadline=0.001)
+
+        await asyncio.wait([first, bulk, urgent, expired])
+        with pytest.raises(asyncio.TimeoutError):
+            expired.result()
+        return urgent.result()
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 'urgent'
+    assert order == ['first', 'urgent', 'bulk']
+    assert manager.expired_jobs == 1
+    manager.close()
+
+
+def test_submit_cancel():
+    manager = AsyncManager(1)
+    cancelled_job = []
+
+    async def run():
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled_job.append(True)
+                raise
+
+        async def quick():
+            return 'quick'
+
+        running = manager.submit(slow)
+        await asyncio.sleep(0.01)
+        running.cancel()
+
+        # The worker keeps going after its job was cancelled
+        return await asyncio.wait_for(manager.submit(quick), 1)
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 'quick'
+    assert cancelled_job == [True]
+    manager.close()
+
+
+def test_submit_bad_job():
+    manager = AsyncManager(1)
+
+    async def run():
+        async def quick():
+            return 'quick'
+
+        # A job that doesn't return an awaitable fails without stopping the
+        # worker
+        with pytest.raises(TypeError):
+            await asyncio.wait_for(manager.submit(lambda: 1), 1)
+
+        return await asyncio.wait_for(manager.submit(quick), 1)
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 'quick'
+    assert manager._running_tasks == 0
+    manager.close()
+
+
+def test_submit_aging():
+    manager = AsyncManager(1, aging=0.01)
+    order = []
+
+    async def run():
+        async def job(name):
+            order.append(name)
+            await asyncio.sleep(0.05)
+
+        busy = manager.submit(partial(job, 'busy'))
+        low = manager.submit(partial(job, 'low'), priority=1)
+        await asyncio.sleep(0.02)
+
+        # Low priority job waited long enough to go ahead
+        high = manager.submit(partial(job, 'high'))
+        await asyncio.wait([busy, low, high])
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert order == ['busy', 'low', 'high']
+    manager.close()
+
+
+def _sleepy_jobs(delays, started):
+    for i, delay in enumerate(delays):
+        async def job(i=i, delay=delay):
+            started.append(i)
+            await asyncio.sleep(delay)
+            return i
+        yield job
+
+
+@pytest.mark.parametrize('ordered, expected', [
+    (False, [1, 2, 4, 3, 0]),
+    (True, [0, 1, 2, 3, 4]),
+])
+def test_results(ordered, expected):
+    manager = AsyncManager(3)
+    started = []
+    delays = [0.1, 0.02, 0.04, 0.06, 0.02]
+
+    async def run():
+        results = []
+        async for result in manager.results(_sleepy_jobs(delays, started),
+                                            ordered=ordered):
+            # Never more than the window started ahead of the results
+            assert len(started) - len(results) <= 3
+            results.append(result)
+        return results
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == expected
+    assert manager._running_tasks == 0
+
+
+def test_results_stop_early():
+    manager = AsyncManager(2)
+    started = []
+
+    async def run():
+        # The first job finishes well before the second, which is still
+        # running when the results are closed.
+        results = manager.results(_sleepy_jobs([0.01] + [0.1] * 9, started))
+        async for result in results:
+            break
+        await results.aclose()
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 0
+    assert len(started) == 2
+    assert manager._running_tasks == 0
+
+
+async def _shard_pid(item):
+    if item < 0:
+        raise ValueError(item)
+    await asyncio.sleep(0)
+    return item, os.getpid()
+
+
+def _sharded_results(manager, items, key=None):
+    async def run():
+        return [r async for r in manager.results(_shard_pid, items, key=key)]
+
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_sharded_manager():
+    manager = ShardedManager(shards=2, tasks=3, batch_size=4)
+
+    results = _sharded_results(manager, range(50))
+    assert sorted(item for item, _ in results) == list(range(50))
+    assert len({pid for _, pid in results} - {os.getpid()}) == 2
+
+    # Items with the same key go to the same process
+    results = _sharded_results(manager, range(50), key=lambda i: i % 2)
+    pids = {item % 2: pid for item, pid in results}
+    assert all(pids[item % 2] == pid for item, pid in results)
+
+
+async def _echo(item):
+    return item
+
+
+def test_sharded_manager_large_batches():
+    # Batches much bigger than the socket buffers in both directions
+    manager = ShardedManager(shards=1)
+    items = [str(i).ljust(100000, 'x') for i in range(300)]
+
+    async def run():
+        return [r async for r in manager.results(_echo, items)]
+
+    results = asyncio.get_event_loop().run_until_complete(
+        asyncio.wait_for(run(), 30))
+    assert results == items
+
+
+async def _crash(item):
+    os._exit(1)
+
+
+def test_sharded_manager_crash():
+    manager = ShardedManager(shards=1)
+
+    async def run():
+        return [r async for r in manager.results(_crash, [1])]
+
+    with pytest.raises(RuntimeError):
+        asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_sharded_manager_error():
+    with pytest.raises(ValueError):
+        _sharded_results(ShardedManager(shards=2), [1, 2, -1, 3])
+
+
+def test_batcher():
+    manager = AsyncManager(3)
+    batches = []
+
+    async def double_all(numbers):
+        batches.append(numbers)
+        return [n * 2 for n in numbers]
+
+    double = manager.batcher(double_all, max_size=4, max_linger=0.01)
+
+    async def run():
+        return await asyncio.gather(*[double(n) for n in range(6)])
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == [
+        0, 2, 4, 6, 8, 10]
+
+    # Full batch right away, and the rest after lingering
+    assert batches == [[0, 1, 2, 3], [4, 5]]
+    assert double.batches == 2
+    assert manager._running_tasks == 0
+
+
+def test_batcher_error():
+    async def wrong_count(items):
+        return items[1:]
+
+    batcher = Batcher(wrong_count)
+
+    async def run():
+        with pytest.raises(ValueError):
+            await asyncio.gather(batcher(1), batcher(2))
+
+    asyncio.get_event_loop().run_until_complete(run())
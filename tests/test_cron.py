@@ -0,0 +1,448 @@
+import asyncio
+from datetime import datetime
+import time
+
+import pytest
+
+from examples.cron import (cron, CronExpression, DailyTime, Histogram,
+                           Journal, Metrics, ProcessPool, RotatingLog,
+                           ScheduleFile, Scheduler, command_args,
+                           parse_trigger, _record_complete)
+
+
+def _timestamp(*args):
+    return datetime(*args).timestamp()
+
+
+def test_daily_time():
+    trigger = DailyTime('6:00 AM')
+    assert trigger.resolution == 60
+    assert trigger.next_after(_timestamp(2020, 1, 1, 5)) == _timestamp(
+        2020, 1, 1, 6)
+    assert trigger.next_after(_timestamp(2020, 1, 1, 6)) == _timestamp(
+        2020, 1, 2, 6)
+
+    trigger = DailyTime('7:00:30 PM')
+    assert trigger.resolution == 1
+    assert trigger.next_after(_timestamp(2020, 1, 1, 19)) == _timestamp(
+        2020, 1, 1, 19, 0, 30)
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('*/7 3-5 * * *', (2024, 1, 31, 3)),
+    ('0 12 * * mon-fri', (2024, 1, 31, 12)),
+    ('0 0 13 * fri', (2024, 2, 2)),          # Day or weekday matches
+    ('30 2 29 2 *', (2024, 2, 29, 2, 30)),
+    ('5 4 * * 7', (2024, 2, 4, 4, 5)),       # 7 is also Sunday
+    ('*/20 * * * * *', (2024, 1, 31)),
+    ('@monthly', (2024, 2, 1)),
+])
+def test_cron_expression(expression, expected):
+    trigger = CronExpression(expression)
+    now = _timestamp(2024, 1, 30, 23, 59, 50)
+    assert trigger.next_after(now) == _timestamp(*expected)
+
+
+def test_cron_expression_dst(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        # 1:40 AM EST, after the 1 AM hour in EDT has passed
+        now = datetime(2024, 11, 3, 1, 40, fold=1).timestamp()
+        assert CronExpression('* * * * *').next_after(now) == now + 60
+        assert CronExpression('*/10 * * * * *').next_after(now) == now + 10
+        assert CronExpression('0 3 * * *').next_after(now) == now + 4800
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_cron_expression_errors():
+    for expression in ('* * * *', '60 * * * *', '* * * foo *',
+                       '0 0 30 2 *'):
+        with pytest.raises(ValueError):
+            CronExpression(expression).next_after(0)
+
+
+def test_parse_trigger():
+    assert isinstance(parse_trigger('6:00 AM'), DailyTime)
+    assert isinstance(parse_trigger('0 6 * * *'), CronExpression)
+    assert parse_trigger('0 6 * * *') is parse_trigger('0 6 * * *')
+
+
+def test_scheduler_order():
+    now = _timestamp(2020, 1, 1, 12)
+    scheduler = Scheduler()
+    scheduler.add('7:00 PM', ['ps'], now=now)
+    scheduler.add('6:00 AM', ['ls'], now=now)
+    scheduler.add('12:00 PM', ['pwd'], now=now + 30)
+
+    # Entry for the current minute is due right away
+    assert scheduler.next_due() == now
+    assert list(scheduler.pop_due(now + 30)) == [('12:00 PM', now, ['pwd'])]
+    assert scheduler.max_lag == 30
+
+    # Re-armed for the next day
+    assert len(scheduler) == 3
+    assert scheduler.next_due() == _timestamp(2020, 1, 1, 19)
+
+    assert [when for when, _, _ in scheduler.pop_due(
+        _timestamp(2020, 1, 2, 6))] == ['7:00 PM', '6:00 AM']
+    assert scheduler.next_due() == _timestamp(2020, 1, 2, 12)
+
+
+def test_scheduler_update():
+    now = _timestamp(2020, 1, 1, 12)
+    scheduler = Scheduler()
+    scheduler.add_schedule({'6:00 AM': ['ls'], '7:00 PM': ['ps'],
+                            '8:00 PM': ['pwd']}, now=now)
+
+    assert scheduler.update({'6:00 AM': ['ls'], '7:00 PM': ['ps -ef'],
+                             '1:00 PM': ['date']}, now=now) == (1, 1, 1)
+    assert len(scheduler) == 3
+    assert '8:00 PM' not in scheduler
+
+    scheduler.remove('1:00 PM')
+    assert [(when, commands) for when, _, commands in scheduler.pop_due(
+        _timestamp(2020, 1, 2, 6))] == [('7:00 PM', ['ps -ef']),
+                                        ('6:00 AM', ['ls'])]
+    assert len(scheduler) == 2
+    assert scheduler.next_due() == _timestamp(2020, 1, 2, 19)
+
+
+def test_scheduler_stuck_trigger(monkeypatch):
+    now = _timestamp(2020, 1, 1, 12)
+    scheduler = Scheduler()
+    scheduler.add('* * * * *', ['ls'], now=now)
+
+    # A trigger that returns a past time is re-armed after now
+    monkeypatch.setattr(CronExpression, 'next_after', lambda self, ts: 0)
+    assert len(list(scheduler.pop_due(now))) == 1
+    assert scheduler.next_due() == now + 60
+
+
+def test_schedule_file(tmpdir):
+    path = tmpdir.join('schedule.json')
+    path.write('{"6:00 AM": ["ls"]}')
+
+    schedule_file = ScheduleFile(str(path))
+    assert schedule_file.changed()
+    assert schedule_file.load() == {'6:00 AM': ['ls']}
+    assert not schedule_file.changed()
+
+    path.write('{"6:00 AM": ["ls", "pwd"]}')
+    assert schedule_file.changed()
+
+    for invalid in ('["ls"]', '{"6:00 AM": [1]}', '{"61 * * * *": ["ls"]}'):
+        path.write(invalid)
+        with pytest.raises(ValueError):
+            schedule_file.load()
+
+
+@pytest.mark.parametrize('catch_up, fires', [
+    ('skip', []),
+    ('once', [(2020, 1, 1, 10)]),
+    ('all', [(2020, 1, 1, 10), (2020, 1, 1, 11)]),
+])
+def test_scheduler_catch_up(tmpdir, catch_up, fires):
+    journal = Journal(str(tmpdir.join('cron.journal')))
+    journal.record_fire('0 * * * *', _timestamp(2020, 1, 1, 9))
+    journal.record_fire('0 0 * * *', _timestamp(2020, 1, 1))
+    journal.record_complete('0 * * * *', _timestamp(2020, 1, 1, 9), 0)
+
+    now = _timestamp(2020, 1, 1, 11, 30)
+    scheduler = Scheduler(journal=journal, catch_up=catch_up)
+    scheduler.add_schedule({'0 * * * *': ['ls']}, now=now)
+
+    assert [due for _, due, _ in scheduler.pop_due(now)] == [
+        _timestamp(*fire) for fire in fires]
+    assert scheduler.next_due() == _timestamp(2020, 1, 1, 12)
+
+    journal.close()
+    events = list(Journal(journal.path).events())
+    assert len(events) == 3 + len(fires)
+    assert [e[1] for e in events[3:]] == [_timestamp(*f) for f in fires]
+
+
+def test_journal_last_fires(tmpdir):
+    path = str(tmpdir.join('cron.journal'))
+    journal = Journal(path)
+    assert journal.last_fires(['6:00 AM']) == {}
+
+    for day in range(1, 10):
+        journal.record_fire('6:00 AM', _timestamp(2020, 1, day, 6))
+        journal.record_fire('7:00 PM', _timestamp(2020, 1, day, 19))
+    journal.close()
+
+    # Partial record from a crash is ignored
+    with open(path, 'ab') as fp:
+        fp.write(b'partial')
+
+    assert Journal(path).last_fires(['6:00 AM', 'ps', '7:00 PM']) == {
+        '6:00 AM': _timestamp(2020, 1, 9, 6),
+        '7:00 PM': _timestamp(2020, 1, 9, 19),
+    }
+
+
+def test_journal_record_complete(tmpdir):
+    journal = Journal(str(tmpdir.join('cron.journal')))
+    future = asyncio.get_event_loop().create_future()
+    future.set_exception(OSError('No space left on device'))
+    _record_complete(journal, '6:00 AM', 1.0, future)
+    journal.close()
+
+    [(_, due, _, status, event)] = journal.events()
+    assert (due, status, event) == (1.0, Journal._NO_STATUS,
+                                    Journal.COMPLETE)
+
+
+def test_journal_checkpoint(tmpdir):
+    path = str(tmpdir.join('cron.journal'))
+    journal = Journal(path, checkpoint_interval=100)
+    journal.record_fire('@yearly', _timestamp(2020, 1, 1))
+    for minute in range(1000):
+        due = _timestamp(2020, 1, 2) + minute * 60
+        journal.record_fire('* * * * *', due)
+    journal.close()
+
+    # Only scans back to the last checkpoint for entries that never fired
+    journal = Journal(path, checkpoint_interval=100)
+    assert journal._load_last_fires()[1] <= 3
+    assert journal.last_fires(['@yearly', '* * * * *', '@daily']) == {
+        '@yearly': _timestamp(2020, 1, 1),
+        '* * * * *': _timestamp(2020, 1, 2) + 999 * 60,
+    }
+    journal.close()
+
+    # A checkpoint cut short by a crash is skipped
+    with open(path, 'ab') as fp:
+        fp.write(Journal._RECORD.pack(1, 0, 0, 0, Journal.CHECKPOINT))
+    assert Journal(path).last_fires(['@yearly']) == {
+        '@yearly': _timestamp(2020, 1, 1)}
+
+
+def test_cron(capfd):
+    schedule = {datetime.now().strftime('%I:%M %p'): ['echo hello']}
+
+    async def run():
+        task = asyncio.ensure_future(cron(schedule))
+        await asyncio.sleep(0.5)
+        task.cancel()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    captured = capfd.readouterr()
+    assert 'Running echo hello' in captured.out
+    assert 'hello\n' in captured.out
+
+
+def test_process_pool(capfd):
+    async def run():
+        pool = ProcessPool(max_running=1)
+
+        # Blocks the pool so the rest are queued and run by priority
+        first = pool.submit('sleep 0.1')
+        later = pool.submit('echo later', priority=1)
+        sooner = pool.submit('echo sooner')
+        failed = pool.submit('exit 3')
+
+        await asyncio.sleep(0.05)
+        assert pool.running == 1
+        assert pool.queued == 3
+
+        await pool.join()
+        assert pool.running == 0
+        statuses = [f.result() for f in (first, later, sooner, failed)]
+        assert statuses == [0, 0, 0, 3]
+
+        await pool.close()
+        return pool
+
+    pool = asyncio.get_event_loop().run_until_complete(run())
+    assert pool.exit_statuses == {0: 3, 3: 1}
+
+    out = capfd.readouterr().out
+    assert out.index('sooner\n') < out.index('later\n')
+
+
+def test_process_pool_cancelled():
+    async def run():
+        pool = ProcessPool(max_running=1)
+        cancelled = pool.submit('sleep 0.1')
+        await asyncio.sleep(0.05)
+        cancelled.cancel()
+
+        # The worker keeps running the queue
+        status = await asyncio.wait_for(pool.submit('true'), 5)
+        await pool.close()
+        return status
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 0
+
+
+def test_process_pool_timeout():
+    async def run():
+        pool = ProcessPool(timeout=0.1)
+        status = await pool.submit('sleep 10 & sleep 10')
+        await pool.close()
+        return status
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == -9
+
+
+def test_command_args():
+    assert command_args('ls -l "my dir"') == ('ls', '-l', 'my dir')
+    assert command_args('echo hi > out.txt') is None
+    assert command_args('echo $HOME') is None
+    assert command_args('FOO=1 ls') is None
+    assert command_args('exit 3') is None   # Shell builtin
+    assert command_args('no-such-command') is None
+
+
+def test_process_pool_exec(tmpdir):
+    async def run():
+        pool = ProcessPool(log_dir=str(tmpdir), use_shell=False)
+        pool.prepare({'* * * * *': ['echo "$HOME"', 'echo "a  b"']})
+        statuses = [await pool.submit('echo "a  b"'),
+                    await pool.submit('exit 3')]
+        await pool.close()
+        return statuses
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == [0, 3]
+    assert command_args.cache_info().currsize >= 2
+    assert [log.read() for log in tmpdir.listdir()] == ['a  b\n']
+
+
+def test_process_pool_logs(tmpdir):
+    async def run():
+        pool = ProcessPool(log_dir=str(tmpdir))
+        await pool.submit('echo out; echo err >&2')
+        await pool.close()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    logs = tmpdir.listdir()
+    assert len(logs) == 1
+    assert logs[0].basename.startswith('echo_out_echo_err_2-')
+    assert logs[0].read() == 'out\nerr\n'
+
+
+def test_process_pool_log_error(tmpdir, monkeypatch):
+    def flush(self):
+        self._buffer.clear()
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(RotatingLog, 'flush', flush)
+
+    async def run():
+        pool = ProcessPool(log_dir=str(tmpdir))
+        status = await asyncio.wait_for(
+            pool.submit('head -c 2000000 /dev/zero'), 5)
+
+        # Output is still drained when the log fails to write
+        running = pool.submit('yes')
+        await asyncio.sleep(0.1)
+        await asyncio.wait_for(pool.close(), 5)
+        return status, running.cancelled()
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == (0, True)
+
+
+def test_rotating_log(tmpdir):
+    path = str(tmpdir.join('job.log'))
+    log = RotatingLog(path, max_bytes=10, backups=2, buffer_size=4)
+
+    log.write(b'123')
+    assert not tmpdir.join('job.log').exists()
+
+    for data in (b'4567', b'89ab', b'cdef', b'ghij'):
+        log.write(data)
+    log.flush()
+
+    assert tmpdir.join('job.log').read() == 'ghij'
+    assert tmpdir.join('job.log.1').read() == '89abcdef'
+    assert tmpdir.join('job.log.2').read() == '1234567'
+    assert not tmpdir.join('job.log.3').exists()
+
+
+def test_cron_reload(tmpdir, capfd, monkeypatch):
+    monkeypatch.setattr(ScheduleFile, 'CHECK_INTERVAL', 0.05)
+    path = tmpdir.join('schedule.json')
+    path.write('{}')
+
+    async def run():
+        task = asyncio.ensure_future(cron(str(path)))
+        await asyncio.sleep(0.1)
+        path.write('{"* * * * * *": ["echo reloaded"]}')
+        await asyncio.sleep(1.5)
+        task.cancel()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    captured = capfd.readouterr()
+    assert '1 added, 0 removed, 0 changed' in captured.out
+    assert 'reloaded\n' in captured.out
+
+
+def test_cron_reload_invalid(tmpdir, capfd, monkeypatch):
+    monkeypatch.setattr(ScheduleFile, 'CHECK_INTERVAL', 0.05)
+    path = tmpdir.join('schedule.json')
+    path.write('{"* * * * * *": ["echo kept"]}')
+
+    async def run():
+        task = asyncio.ensure_future(cron(str(path)))
+        await asyncio.sleep(0.1)
+        path.write('{"61 * * * *": ["echo bad"]}')
+        await asyncio.sleep(0.2)
+        capfd.readouterr()
+
+        # Still running the current schedule
+        await asyncio.sleep(1.2)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    captured = capfd.readouterr()
+    assert 'kept\n' in captured.out
+    assert 'bad' not in captured.out
+
+
+def test_histogram():
+    histogram = Histogram('lag', 'Lag', (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+
+    assert histogram.snapshot() == {'buckets': (0.1, 1), 'counts': [2, 1, 1],
+                                    'sum': 2.65, 'count': 4}
+    assert histogram.to_prometheus() == [
+        '# HELP lag Lag', '# TYPE lag histogram', 'lag_bucket{le="0.1"} 2',
+        'lag_bucket{le="1"} 3', 'lag_bucket{le="+Inf"} 4', 'lag_sum 2.65',
+        'lag_count 4']
+
+
+def test_cron_metrics(tmpdir, capfd):
+    path = str(tmpdir.join('cron.prom'))
+    metrics = Metrics(path)
+    schedule = {datetime.now().strftime('%I:%M %p'): ['echo hello']}
+
+    async def run():
+        task = asyncio.ensure_future(cron(schedule, metrics=metrics))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await asyncio.wait([task])
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+    snapshot = metrics.snapshot()
+    assert snapshot['cron_fire_lag_seconds']['count'] == 1
+    assert snapshot['cron_start_lag_seconds']['count'] == 1
+    assert snapshot['cron_command_runtime_seconds']['count'] == 1
+    assert snapshot['cron_scheduled_entries'] == 1
+    assert snapshot['cron_running_commands'] == 0
+
+    with open(path) as fp:
+        dump = fp.read()
+    assert 'cron_command_runtime_seconds_count 1\n' in dump
+    assert ('# TYPE cron_queued_commands gauge\n'
+            'cron_queued_commands 0\n') in dump
@@ -1,5 +1,13 @@
+import asyncio
 import re
-from examples.decorator import main, echo, mecho
+from threading import Thread
+from time import sleep
+
+import pytest
+
+from examples import decorator
+from examples.decorator import (main, echo, mecho, memoize, instrument,
+                                instrumented_stats, set_instrumentation)
 
 
 def test_echo():
@@ -17,3 +25,181 @@ def test_main(capsys):
     assert re.fullmatch('Main started.*don\'t you?.*',
                         captured.out,
                         flags=re.MULTILINE | re.DOTALL)
+
+
+def test_memoize():
+    calls = []
+
+    @memoize(max_entries=2)
+    def add(a, b=0):
+        """ Adds numbers """
+        calls.append((a, b))
+        return a + b
+
+    assert add.__doc__ == ' Adds numbers '
+    assert add(1) == add(1) == 1
+    assert add(1, 2) == 3
+    assert add(1, b=2) == 3
+    assert calls == [(1, 0), (1, 2), (1, 2)]
+
+    # (1,) was least recently used, so evicted
+    assert add(1) == 1
+    assert len(calls) == 4
+
+    info = add.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.size) == (
+        1, 4, 2, 2)
+
+    add.cache_clear()
+    assert add.cache_info().size == 0
+    add(1, b=2)
+    assert len(calls) == 5
+
+
+def test_memoize_ttl():
+    calls = []
+
+    @memoize(ttl=0.05)
+    def now(value):
+        calls.append(value)
+        return len(calls)
+
+    assert now('a') == now('a') == 1
+    sleep(0.06)
+    assert now('a') == 2
+    assert now.cache_info().expired == 1
+
+
+def test_memoize_max_bytes():
+    @memoize(max_entries=None, max_bytes=100, sizeof=len)
+    def data(size):
+        return b'x' * size
+
+    for size in (40, 40, 30, 50, 200):
+        data(size)
+
+    # 40 was evicted to fit 50, and 200 doesn't fit at all
+    info = data.cache_info()
+    assert (info.size, info.bytes, info.evictions) == (2, 80, 1)
+
+    data(30)
+    assert data.cache_info().hits == 2
+
+
+def test_memoize_async():
+    calls = []
+
+    @memoize()
+    async def fetch(url):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        if url == 'bad':
+            raise ValueError(url)
+        return url.upper()
+
+    async def test():
+        # Concurrent misses share one call
+        results = await asyncio.gather(*[fetch('a') for _ in range(5)])
+        assert results == ['A'] * 5
+        assert await fetch('a') == 'A'
+        assert calls == ['a']
+
+        # Errors are not cached
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                await fetch('bad')
+        assert calls == ['a', 'bad', 'bad']
+
+        # Cancelling one caller doesn't cancel the others
+        first = asyncio.ensure_future(fetch('b'))
+        second = asyncio.ensure_future(fetch('b'))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'B'
+        assert calls == ['a', 'bad', 'bad', 'b']
+
+    asyncio.get_event_loop().run_until_complete(test())
+    assert fetch.cache_info().hits == 1
+
+
+class Counter:
+    @instrument
+    def add(self, value):
+        if value < 0:
+            raise ValueError(value)
+        return value + 1
+
+
+def test_instrument():
+    counter = Counter()
+
+    def work():
+        for value in range(1000):
+            counter.add(value)
+
+    threads = [Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with pytest.raises(ValueError):
+        counter.add(-1)
+
+    stats = instrumented_stats()[__name__ + '.Counter.add']
+    assert stats.calls == 4001
+    assert stats.errors == 1
+    assert stats.total_ns > 0
+    assert sum(stats.buckets.values()) == 4001
+    assert Counter.add.__name__ == 'add'
+
+
+def test_instrument_async():
+    @instrument
+    async def wait(delay):
+        await asyncio.sleep(delay)
+
+    asyncio.get_event_loop().run_until_complete(wait(0.01))
+
+    stats = wait.stats()
+    assert stats.calls == 1
+    assert stats.total_ns >= 10000000
+    assert max(stats.buckets) >= 10000000
+
+
+def test_set_instrumentation():
+    wrapper = decorator.increment
+    original = wrapper.__wrapped__
+    method = Counter.add
+
+    set_instrumentation(False)
+    try:
+        assert decorator.increment is original
+        assert Counter.add is method.__wrapped__
+
+        @instrument
+        def added_while_disabled():
+            pass
+        assert not hasattr(added_while_disabled, 'stats')
+
+        calls = wrapper.stats().calls
+        assert decorator.increment(1) == 2
+        assert wrapper.stats().calls == calls
+
+    finally:
+        set_instrumentation(True)
+
+    assert decorator.increment is wrapper
+    assert Counter.add is method
+    assert decorator.increment(1) == 2
+    assert wrapper.stats().calls == calls + 1
+
+
+def test_benchmark(capsys):
+    stats = instrumented_stats()
+    decorator.benchmark(calls=1000)
+    assert instrumented_stats().keys() == stats.keys()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(':')[0] for line in lines[-4:]] == [
+        'Bare function', 'Instrumented', 'Instrumented, disabled', 'double']
@@ -0,0 +1,78 @@
+import os
+import pstats
+import tracemalloc
+
+import pytest
+
+from examples.profiling import main, profiled
+
+
+SCRIPT = '''
+import sys
+from time import process_time
+
+
+def busy():
+    start_time = process_time()
+    while process_time() - start_time < 0.2:
+        sum(range(1000))
+
+
+if __name__ == "__main__":
+    data = [bytearray(1024) for _ in range(100)]
+    busy()
+    print('args', sys.argv[1:])
+'''
+
+
+@pytest.mark.parametrize('profiler, extensions', [
+    ('cprofile', ['.prof', '.txt']),
+    ('sample', ['.folded', '.txt']),
+    ('memory', ['.snapshot', '.txt'])])
+def test_main(profiler, extensions, tmpdir, monkeypatch, capsys):
+    script = tmpdir.join('busy.py')
+    script.write(SCRIPT)
+    output_dir = tmpdir.join('profiles')
+    monkeypatch.setenv('PROFILE', profiler)
+    monkeypatch.setattr('sys.argv', ['profiling.py'])
+    monkeypatch.setattr('sys.path', list(os.sys.path))
+
+    main(['--profile-dir', str(output_dir), str(script), '--fast', '1'])
+
+    out, err = capsys.readouterr()
+    assert out == "args ['--fast', '1']\n"
+    assert 'Saved profile to' in err
+
+    files = sorted(os.listdir(str(output_dir)))
+    assert [os.path.splitext(f)[1] for f in files] == extensions
+    assert all(f.startswith('busy-' + profiler + '-') for f in files)
+
+    path = str(output_dir.join(os.path.splitext(files[0])[0]))
+    with open(path + '.txt') as fp:
+        summary = fp.read()
+
+    if profiler == 'cprofile':
+        stats = pstats.Stats(path + '.prof')
+        assert any(func == 'busy' for _, _, func in stats.stats)
+        assert 'busy' in summary
+
+    elif profiler == 'sample':
+        assert 'busy.py:busy' in summary
+        with open(path + '.folded') as fp:
+            assert 'busy.py:busy' in fp.read()
+
+    else:
+        snapshot = tracemalloc.Snapshot.load(path + '.snapshot')
+        assert snapshot.statistics('lineno')
+        assert 'busy.py:13' in summary
+
+
+def test_profiled_interrupted(tmpdir):
+    with pytest.raises(KeyboardInterrupt):
+        with profiled('sample', str(tmpdir), 'stopped'):
+            raise KeyboardInterrupt()
+    assert len(tmpdir.listdir()) == 2
+
+    with pytest.raises(ValueError):
+        with profiled('unknown', str(tmpdir)):
+            pass
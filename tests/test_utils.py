@@ -1,5 +1,6 @@
+import asyncio
 from time import sleep
-from examples.utils import show_duration
+from examples.utils import show_duration, timer, Timer
 
 
 def test_duration(capsys):
@@ -7,3 +8,84 @@ def test_duration(capsys):
         sleep(0.01)
     out, err = capsys.readouterr()
     assert out == 'quick task took 0.01 seconds\n'
+    assert timer.timing('quick task').count >= 1
+
+
+def test_timer_spans():
+    timer = Timer()
+
+    with timer.span('outer') as outer:
+        for _ in range(3):
+            with timer.span('inner'):
+                sleep(0.001)
+    with timer.span('inner'):
+        pass
+
+    assert outer.path == 'outer'
+    assert outer.duration_ns >= 3000000
+    assert sorted(timer.export()) == ['inner', 'outer', 'outer/inner']
+
+    inner = timer.timing('outer/inner')
+    assert inner.count == 3
+    assert 1000000 <= inner.min_ns <= inner.max_ns
+    assert inner.total_ns >= 3000000
+    assert inner.min_ns <= inner.percentile_ns(0.5) <= inner.max_ns
+
+    exported = timer.export()['outer/inner']
+    assert sum(exported['buckets'].values()) == 3
+    assert all(bound > exported['min_ns'] for bound in exported['buckets'])
+
+    report = timer.report().splitlines()
+    assert report[0].split() == ['span', 'count', 'total', 'mean', 'min',
+                                 'p99', 'max']
+    assert report[3].split()[:2] == ['outer/inner', '3']
+
+    timer.reset()
+    assert timer.export() == {}
+
+
+def test_timer_async_spans():
+    timer = Timer()
+
+    @timer.timed()
+    async def fetch(delay):
+        await asyncio.sleep(delay)
+
+    @timer.timed('parse')
+    def parse():
+        return 'parsed'
+
+    async def handle(delay):
+        async with timer.span('handle'):
+            await fetch(delay)
+            return parse()
+
+    async def test():
+        async with timer.span('request'):
+            return await asyncio.gather(handle(0.02), handle(0.01))
+
+    assert asyncio.get_event_loop().run_until_complete(test()) == [
+        'parsed', 'parsed']
+
+    assert sorted(timer.export()) == [
+        'request', 'request/handle', 'request/handle/parse',
+        'request/handle/test_timer_async_spans.<locals>.fetch']
+    assert timer.timing('request/handle').count == 2
+    assert parse.__name__ == 'parse'
+
+
+def test_timer_disabled():
+    timer = Timer(enabled=False)
+
+    @timer.timed()
+    def add(a, b):
+        return a + b
+
+    with timer.span('noop') as span:
+        assert add(1, 2) == 3
+    assert span.duration_ns is None
+    assert timer.export() == {}
+
+    timer.enabled = True
+    assert add(1, 2) == 3
+    assert timer.timing('test_timer_disabled.<locals>.add').count == 1